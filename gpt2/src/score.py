@@ -1,5 +1,7 @@
 import json
 import os
+import time
+import collections
 import numpy as np
 import tensorflow as tf
 import fire
@@ -26,16 +28,7 @@ def top_k_logits(logits, k):
        lambda: _top_k(),
     )
 
-def score_model(
-    model_name='117M',
-    seed=None,
-    nsamples=1,
-    length=None,
-    temperature=1,
-    top_k=0,
-    context_token=[]
-):
-    enc = get_encoder(model_name)
+def load_hparams(model_name):
     hparams = default_hparams()
     try:
         with open(os.path.join('gpt2/models', model_name, 'hparams.json')) as f:
@@ -43,29 +36,149 @@ def score_model(
     except:
         with open(os.path.join('models', model_name, 'hparams.json')) as f:
             hparams.override_from_dict(json.load(f))
+    return hparams
 
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth=True
+class GPT2Scorer:
+    """
+    Resident GPT-2 scorer: the graph is built and the checkpoint restored once,
+    then score() serves any number of calls from the same session.
+    """
 
-    with tf.Session(config=config) as sess:
+    def __init__(self, model_name='117M'):
+        self.model_name = model_name
+        self.startup_times = collections.OrderedDict()
+        self.call_times = []
 
-        context = tf.placeholder(tf.int32, [len(context_token), None],name="context")
-        lm_output = model(hparams=hparams, X=context, past=None, reuse=tf.AUTO_REUSE)
-        logits = lm_output['logits'][:, :, :hparams.n_vocab]
-        logits = logits[:, -1, :]  / tf.to_float(temperature)
-        logits = top_k_logits(logits, k=top_k)
-        logits = tf.nn.softmax(logits, axis=1)
+        start = time.time()
+        self.hparams = load_hparams(model_name)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.context = tf.placeholder(tf.int32, [None, None], name="context")
+            self.temperature = tf.placeholder_with_default(1., shape=())
+            self.top_k = tf.placeholder_with_default(0, shape=())
+            lm_output = model(hparams=self.hparams, X=self.context, past=None, reuse=tf.AUTO_REUSE)
+            logits = lm_output['logits'][:, :, :self.hparams.n_vocab]
+            logits = logits[:, -1, :]  / self.temperature
+            logits = top_k_logits(logits, k=self.top_k)
+            self.probs = tf.nn.softmax(logits, axis=1)
 
-        saver = tf.train.Saver()
+            # Incremental decoding: only the new tokens are fed, attending to
+            # the keys/values of everything before them (past)
+            self.step_tokens = tf.placeholder(tf.int32, [None, None], name="step_tokens")
+            self.step_past = tf.placeholder_with_default(
+                tf.zeros(past_shape(hparams=self.hparams, sequence=0, batch_size=tf.shape(self.step_tokens)[0])),
+                past_shape(hparams=self.hparams))
+            # A prefix shared by every row (the prompt of a poem) is fed once,
+            # batch 1, and tiled to the rows in the graph
+            self.step_prefix = tf.placeholder_with_default(
+                tf.zeros(past_shape(hparams=self.hparams, sequence=0, batch_size=1)),
+                past_shape(hparams=self.hparams, batch_size=1))
+            prefix = tf.tile(self.step_prefix, [tf.shape(self.step_tokens)[0], 1, 1, 1, 1, 1])
+            step_output = model(hparams=self.hparams, X=self.step_tokens, past=tf.concat([prefix, self.step_past], axis=-2), reuse=tf.AUTO_REUSE)
+            step_logits = step_output['logits'][:, -1, :self.hparams.n_vocab] / self.temperature
+            self.step_probs = tf.nn.softmax(top_k_logits(step_logits, k=self.top_k), axis=1)
+            self.step_next_past = tf.concat([self.step_past, step_output['present']], axis=-2)
+            saver = tf.train.Saver()
+        self.startup_times['build graph'] = time.time() - start
+
+        start = time.time()
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth=True
+        self.sess = tf.Session(graph=self.graph, config=config)
         ckpt = tf.train.latest_checkpoint(os.path.join('gpt2/models', model_name))
-        saver.restore(sess, ckpt)
+        saver.restore(self.sess, ckpt)
+        self.startup_times['restore checkpoint'] = time.time() - start
 
-        out = sess.run(logits, feed_dict={
-            context: context_token
+    def score(self, context_tokens, temperature=1, top_k=0):
+        """
+        Next-token distribution after each row of context_tokens (a batch of
+        equal-length token lists), the same array score_model returns.
+        """
+        start = time.time()
+        out = self.sess.run(self.probs, feed_dict={
+            self.context: context_tokens, self.temperature: temperature, self.top_k: top_k
         })
+        self.call_times.append(time.time() - start)
+        return out
+
+    def start(self, context_tokens, temperature=1, top_k=0):
+        """
+        Begins incremental decoding: runs the context once and returns the
+        next-token distribution of each row together with its past, the
+        per-layer keys and values extend() continues from.
+        """
+        return self.extend(None, context_tokens, temperature, top_k)
+
+    def extend(self, past, tokens, temperature=1, top_k=0, prefix=None):
+        """
+        Feeds tokens (batch, n new tokens) after past and returns the
+        distribution after the last of them and the past grown by n. Costs n
+        tokens per row, however long the context behind past is.
+
+        prefix is the batch-1 past of a context every row shares, attended
+        to before past but neither fed per row nor returned: the rows only
+        carry the keys/values of their own tokens.
+        """
+        start = time.time()
+        feed = {self.step_tokens: tokens, self.temperature: temperature, self.top_k: top_k}
+        if past is not None:
+            feed[self.step_past] = past
+        if prefix is not None:
+            feed[self.step_prefix] = prefix
+        out = self.sess.run([self.step_probs, self.step_next_past], feed_dict=feed)
+        self.call_times.append(time.time() - start)
+        return out
+
+    def extend_prefix(self, prefix, tokens, temperature=1, top_k=0):
+        """
+        Appends tokens (one list) to a shared prefix: returns the
+        distribution after them and the grown batch-1 prefix, paying only
+        for the new tokens.
+        """
+        probs, past = self.extend(None, [tokens], temperature, top_k, prefix=prefix)
+        return probs, np.concatenate([prefix, past], axis=-2)
 
-        sess.close()
-    return out
+    @staticmethod
+    def reorder(past, rows):
+        """
+        The past of the hypotheses kept after pruning: row i of the result is
+        row rows[i] of past, so a hypothesis may appear any number of times.
+        """
+        return np.take(past, rows, axis=0)
+
+    def timing_report(self):
+        """
+        The one-off build and restore cost next to the per-call cost.
+        """
+        rows = ['gpt2 {}'.format(self.model_name)]
+        for label, t in self.startup_times.items():
+            rows.append('    {:28} {:8.3f}s'.format(label, t))
+        if self.call_times:
+            rows.append('  {:30} {:5d} calls {:8.3f}s total {:8.4f}s/call'.format(
+                'score', len(self.call_times), sum(self.call_times), sum(self.call_times) / len(self.call_times)))
+        return '\n'.join(rows)
+
+    def close(self):
+        self.sess.close()
+
+# One resident scorer per model, built on first use
+scorers = {}
+
+def get_scorer(model_name='117M'):
+    if model_name not in scorers:
+        scorers[model_name] = GPT2Scorer(model_name)
+    return scorers[model_name]
+
+def score_model(
+    model_name='117M',
+    seed=None,
+    nsamples=1,
+    length=None,
+    temperature=1,
+    top_k=0,
+    context_token=[]
+):
+    return get_scorer(model_name).score(context_token, temperature=temperature, top_k=top_k)
 
 if __name__ == '__main__':
     #fire.Fire(score_model)
@@ -14,6 +14,8 @@ import os
 from .model_back import Model as Model_back
 from .model_forw import Model as Model_forw
 from .functions import *
+from .candidates import CandidateIndex, read_meter_dict
+from .rnn_state import split_states
 
 from gensim.parsing.preprocessing import remove_stopwords
 from nltk.corpus import wordnet as wn
@@ -24,7 +26,8 @@ import requests
 class Generate:
     def __init__(self, wv_file=None, wv=None, save_dir="py_files/models/all_combined_forward",
             save_dir_back="py_files/models/all_combined_back", input="py_files/models/data/combined/input.txt",
-            postag_file="py_files/saved_objects/postag_dict_all.p"):
+            postag_file="py_files/saved_objects/postag_dict_all.p",
+            syllables_file="py_files/saved_objects/cmudict-0.7b.txt"):
         #LOAD DIRECTORY OF MODELS
         text_list = [("models/data/combined/input.txt","models/all_combined_forward"),
             ("models/data/combined/input.txt","models/all_combined_back")]
@@ -83,6 +86,11 @@ class Generate:
             self.postag_dict = pickle.load(f)
 
         self.PartOfSpeachSet=self.postag_dict[1]
+        #VOCAB IDS PER (POS, SYLLABLES) SLOT, BUILT ONCE HERE RATHER THAN AT EVERY BEAM LEVEL
+        with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
+            word_keys, vocab = cPickle.load(f)
+        self.dictSyllables = read_meter_dict(syllables_file)
+        self.candidates = CandidateIndex(self.PartOfSpeachSet, vocab, self.dictSyllables)
         self.TemplatePOS=['PRP', 'VBZ', 'DT', 'NN', 'VBG', 'TO', 'DT', 'NN']
 
     def get_postag_dict(self):
@@ -135,7 +143,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir_back, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_back(saved_args, True)
+        model = Model_back(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -150,7 +158,7 @@ class Generate:
                 init_score = np.array([[0]])
                 #search barckwards function in functions.py
                 lst = search_back_no_rhymes(model, vocab, init_score,[word_last],state, sess, 1,\
-                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, TemplatePOS)
+                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, TemplatePOS, candidates=self.candidates)
                 lst.sort(key=itemgetter(0), reverse = True)
         print("Generation took {:.3f} seconds".format(time.time() - start))
         return lst
@@ -174,7 +182,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_forw(saved_args, True)
+        model = Model_forw(saved_args, True, inference_only=True)
         print (len(vocab))
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
@@ -194,7 +202,7 @@ class Generate:
                     init_score = np.array([[0]])
                 #function in functions.py
                 lst = search_forward(model, vocab, init_score,[word_last],state, sess, 1,\
-                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, TemplatePOS)
+                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, TemplatePOS, candidates=self.candidates)
                 lst.sort(key=itemgetter(0), reverse = True)
                 # line diagnostics
                 #for i in range(10)
@@ -229,7 +237,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_forw(saved_args, True)
+        model = Model_forw(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -370,7 +378,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_forw(saved_args, True)
+        model = Model_forw(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -389,7 +397,7 @@ class Generate:
                     seq=element[1][1]
                     #generate text after word2
                     lst = search_forward(model, vocab, init_score,seq,state, sess, 1,\
-                                      self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template[first_pos:])
+                                      self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template[first_pos:], candidates=self.candidates)
                     tt_3+=lst
                 tt_3.sort(key=itemgetter(0), reverse = True)
         #load backwards model
@@ -398,7 +406,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir_back, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_back(saved_args, True)
+        model = Model_back(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -409,13 +417,13 @@ class Generate:
                 line_num = 0
                 wordPool_ind = 0
                 tt_4=[]
-                for tup in tt_3[:10]:
-                    seq=tup[1][1]
-                    #get states of the generated text (from word1 to the end of the line)
-                    init_score, state=model.score_a_list(sess, vocab, seq)
+                seqs=[tup[1][1] for tup in tt_3[:10]]
+                #get states of the generated text (from word1 to the end of the line), all lines in one run
+                init_scores, states=model.score_batch(sess, vocab, seqs) if seqs else ([], None)
+                for seq, init_score, state in zip(seqs, init_scores, split_states(states, len(seqs))):
                     #generate text before word1
                     lst = search_back_no_rhymes(model, vocab, init_score,seq,state, sess, 1,\
-                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template)
+                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template, candidates=self.candidates)
 
                     tt_4+=lst
         tt_4.sort(key=itemgetter(0), reverse = True)
@@ -482,7 +490,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_forw(saved_args, True)
+        model = Model_forw(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -499,7 +507,7 @@ class Generate:
                     init_score = element[1][0][0]
                     seq=element[1][1]
                     lst = search_forward(model, vocab, init_score,seq,state, sess, 1,\
-                                      self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template[first_pos:])
+                                      self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template[first_pos:], candidates=self.candidates)
                     tt_3+=lst
                 tt_3.sort(key=itemgetter(0), reverse = True)
 
@@ -508,7 +516,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir_back, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_back(saved_args, True)
+        model = Model_back(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
@@ -519,11 +527,11 @@ class Generate:
                 line_num = 0
                 wordPool_ind = 0
                 tt_4=[]
-                for tup in tt_3[:30]:
-                    seq=tup[1][1]
-                    init_score, state=model.score_a_list(sess, vocab, seq)
+                seqs=[tup[1][1] for tup in tt_3[:30]]
+                init_scores, states=model.score_batch(sess, vocab, seqs) if seqs else ([], None)
+                for seq, init_score, state in zip(seqs, init_scores, split_states(states, len(seqs))):
                     lst = search_back(model, vocab, init_score,seq,state, sess, 1,\
-                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template)
+                                  self.dictPartSpeechTags,self.dictPossiblePartsSpeech,self.width,self.wordPools[wordPool_ind], self.PartOfSpeachSet, template, candidates=self.candidates)
 
                     tt_4+=lst
             else:
@@ -674,7 +682,7 @@ class Generate:
             saved_args = cPickle.load(f)
         with open(os.path.join(self.save_dir, 'words_vocab.pkl'), 'rb') as f:
             word_keys, vocab = cPickle.load(f)
-        model = Model_forw(saved_args, True)
+        model = Model_forw(saved_args, True, inference_only=True)
         with tf.Session() as sess:
             tf.global_variables_initializer().run()
             saver = tf.train.Saver(tf.global_variables())
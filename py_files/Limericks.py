@@ -10,30 +10,90 @@ import os
 import re
 import random
 import itertools
-import requests
 import pickle
-import heapq
+import multiprocessing
+import concurrent.futures
 
 from .model_back import Model as Model_back
-from .functions import search_back_meter
+from .model_forw import Model as Model_forw
+from .model_session import ModelSession
+from .scheduler import MicroBatcher
+from .functions import search_back_meter, search_back_meter_many
+from .search import CancellableModel
+from .candidates import CandidateIndex, read_meter_dict
+from .rhymes import RhymeIndex, read_pronunciations
+from .gpt2_vocab import GPT2Vocab
+from .datamuse import get_client, DATAMUSE_URL, DATAMUSE_CACHE
+from .rnn_state import stack_states, split_states
+from .beam import Beam, BeamHistory
+from .export_model import is_export, load_export
 from .templates import get_templates
 
-from gpt2.src.score import score_model
+from gpt2.src.score import score_model, scorers, get_scorer
 from gpt2.src.generate_prompt import generate_prompt
 from gpt2.src.encoder import get_encoder
 from .templates import get_first_nnp
 import pickle
 
+# Generator of each worker process started by Limerick_Generate.start_workers,
+# and the id of the gen_best_line call the pool is working for
+_worker_generator = None
+_worker_call = None
+
+def _init_worker(init_kwargs, current_call):
+    """
+    Runs once in every worker process: builds its own Limerick_Generate and
+    restores the backward model, so each task only pays for its search.
+    """
+    global _worker_generator, _worker_call
+    _worker_generator = Limerick_Generate(**init_kwargs)
+    _worker_generator.model_back
+    _worker_call = current_call
+
+def _worker_template_line(call, *args):
+    """
+    Limerick_Generate.template_line run on the worker's generator. The search
+    is abandoned between beam levels once gen_best_line call has returned.
+    """
+    _worker_generator.cancelled = lambda: _worker_call.value != call
+    try:
+        return _worker_generator.template_line(*args)
+    finally:
+        _worker_generator.cancelled = None
+
 class Limerick_Generate:
 
     def __init__(self, wv_file='py_files/saved_objects/poetic_embeddings.300d.txt',
             syllables_file='py_files/saved_objects/cmudict-0.7b.txt',
             postag_file='py_files/saved_objects/postag_dict_all.p',
-            model_dir='py_files/models/all_combined_back'):
-        self.api_url = 'https://api.datamuse.com/words'
+            model_dir='py_files/models/all_combined_back',
+            model_dir_forw='py_files/models/all_combined_forward',
+            engine='tf', offline_rhymes=True, datamuse_source=DATAMUSE_URL,
+            datamuse_cache=DATAMUSE_CACHE):
+        # Kept so worker processes can build the same generator
+        self.init_kwargs = dict(wv_file=wv_file, syllables_file=syllables_file, postag_file=postag_file,
+            model_dir=model_dir, model_dir_forw=model_dir_forw, engine=engine, offline_rhymes=offline_rhymes,
+            datamuse_source=datamuse_source, datamuse_cache=datamuse_cache)
+        self.workers = None
+        self.worker_call = None
+        self.batcher = None
+        # Set on a worker's generator while its search may still be cancelled
+        self.cancelled = None
+        # Datamuse url (or a local stand-in server, or a snapshot file), with
+        # the responses cached on disk; the client is shared with the rest of
+        # the process (e.g. Meta_Poetry_Glove)
+        self.datamuse = get_client(datamuse_source, datamuse_cache)
         self.ps = nltk.stem.PorterStemmer()
         self.punct = re.compile(r'[^\w\s]')
         self.model_dir = model_dir
+        self.model_dir_forw = model_dir_forw
+        self.syllables_file = syllables_file
+        # 'tf', 'numpy' or 'int8', see ModelSession
+        self.engine = engine
+        # Checkpoints are restored on first use and then kept for every later line
+        self._model_back = None
+        self._model_forw = None
+        self._gpt2_vocab = None
         self.poetic_vectors = KeyedVectors.load_word2vec_format(wv_file, binary=False)
 
         self.create_syll_dict(syllables_file)
@@ -44,6 +104,17 @@ class Limerick_Generate:
         self.words_to_pos = postag_dict[2]
         self.create_pos_syllables()
         self.create_templates_dict(postag_dict[0])
+        # Rhymes from the cmudict phonemes instead of a Datamuse query per word
+        self.rhyme_index = RhymeIndex(syllables_file, self.pos_to_words) if offline_rhymes else None
+
+        # Vocab ids each (pos, syllable count) slot may take, so the beam search
+        # does not rebuild them at every level. Both models share words_vocab.pkl.
+        if is_export(model_dir):
+            self.vocab = load_export(model_dir)[2]
+        else:
+            with open(os.path.join(model_dir, 'words_vocab.pkl'), 'rb') as f:
+                self.vocab = pickle.load(f)[1]
+        self.candidates = CandidateIndex(self.pos_to_words, self.vocab, self.dict_meters)
 
         self.first_line_words=pickle.load(open('py_files/saved_objects/first_line.p','rb'))
         self.width = 20
@@ -51,6 +122,110 @@ class Limerick_Generate:
         self.word_pools = [set([]) for n in range(4)]
         self.enc = get_encoder('117M')
 
+    @property
+    def model_back(self):
+        """
+        The backward model, built and restored the first time it is needed.
+        """
+        if self._model_back is None:
+            self._model_back = ModelSession(Model_back, self.model_dir, engine=self.engine)
+        return self._model_back
+
+    @property
+    def model_forw(self):
+        """
+        The forward model, built and restored the first time it is needed.
+        """
+        if self._model_forw is None:
+            self._model_forw = ModelSession(Model_forw, self.model_dir_forw, engine=self.engine)
+        return self._model_forw
+
+    @property
+    def gpt2_vocab(self):
+        """
+        POS, syllable and rhyme tables over the GPT-2 vocabulary, built the
+        first time a GPT-2 line is generated.
+        """
+        if self._gpt2_vocab is None:
+            self._gpt2_vocab = GPT2Vocab(self.enc, self.words_to_pos, self.dict_meters,
+                read_pronunciations(self.syllables_file))
+        return self._gpt2_vocab
+
+    def start_workers(self, n_workers=None):
+        """
+        Starts a pool of worker processes for gen_best_line(parallel=True).
+        Each worker builds its own generator with the same arguments as this
+        one and keeps its model restored for every template it is given.
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            Number of processes, one per core by default.
+        """
+        if self.workers is None:
+            # spawn, not fork: a forked child must not inherit a live TF session
+            context = multiprocessing.get_context('spawn')
+            # Id of the current gen_best_line call, bumped when it returns so
+            # the searches still running for it stop
+            self.worker_call = context.Value('i', 0)
+            self.workers = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(),
+                mp_context=context, initializer=_init_worker, initargs=(self.init_kwargs, self.worker_call))
+        return self.workers
+
+    def stop_workers(self):
+        if self.workers is not None:
+            # Searches still running stop at their next beam level
+            with self.worker_call.get_lock():
+                self.worker_call.value += 1
+            self.workers.shutdown(wait=False)
+            self.workers = None
+            self.worker_call = None
+
+    def start_batcher(self, max_batch_size=256, max_wait=0.002):
+        """
+        Puts a scheduler.MicroBatcher in front of the backward model, so the
+        searches of lines generated concurrently on threads (e.g. one per
+        request of a service) share their model calls.
+
+        Parameters
+        ----------
+        max_batch_size : int, optional
+            Most beam rows run in one model call.
+        max_wait : float, optional
+            Seconds the first step of a batch waits for others to join it.
+        """
+        if self.batcher is None:
+            self.batcher = MicroBatcher(self.model_back, max_batch_size, max_wait)
+        return self.batcher
+
+    def stop_batcher(self):
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+    @property
+    def step_model(self):
+        """
+        What the backward searches run their steps on: the batcher when one is
+        started, the backward model otherwise. On a worker whose search may be
+        cancelled, each step first checks it is still wanted.
+        """
+        model = self.batcher if self.batcher is not None else self.model_back.model
+        if self.cancelled is not None:
+            return CancellableModel(model, self.cancelled)
+        return model
+
+    def timing_report(self):
+        """
+        Prints the one-off startup cost of each loaded model next to the
+        per-call cost of the lines and states generated with it.
+        """
+        for m in (self._model_back, self._model_forw):
+            if m is not None:
+                print(m.timing_report())
+        for scorer in scorers.values():
+            print(scorer.timing_report())
+
     def create_syll_dict(self, fname):
         """
         Using the cmudict file, returns a dictionary mapping words to their
@@ -63,31 +238,7 @@ class Limerick_Generate:
             The name of the file containing the mapping of words to their
             intonations.
         """
-        with open(fname) as f:
-            lines = [line.rstrip("\n").split() for line in f if (";;;" not in line)]
-            self.dict_meters = {}
-            for i in range(len(lines)):
-                line = lines[i]
-                newLine = [line[0].lower()]
-                if("(" in newLine[0] and ")" in newLine[0]):
-                    newLine[0] = newLine[0][:-3]
-                chars = ""
-                for word in line[1:]:
-                    for ch in word:
-                        if(ch in "012"):
-                            if(ch == "2"):
-                                chars+="1"
-                            else:
-                                chars+=ch
-                newLine+=[chars]
-                lines[i] = newLine
-                if(newLine[0] not in self.dict_meters): #THIS IF STATEMENT ALLOWS FOR MULTIPLE PRONUNCIATIONS OF A WORD
-                    self.dict_meters[newLine[0]]=[chars]
-                else:
-                    if(chars not in self.dict_meters[newLine[0]]):
-                        self.dict_meters[newLine[0]]+=[chars]
-            self.dict_meters[','] = ['']
-            self.dict_meters['.'] = ['']
+        self.dict_meters = read_meter_dict(fname)
 
     def create_pos_syllables(self):
         """
@@ -169,6 +320,28 @@ class Limerick_Generate:
 
         return best_word
 
+    def get_rhymes(self, word):
+        """
+        The words that rhyme with word, best first: from the offline cmudict
+        index unless the generator was built with offline_rhymes=False, in
+        which case Datamuse is asked and its ranking kept.
+
+        Offline rhymes are limited to the words postag_dict_all tags and ranked
+        by their poetic_vectors similarity to word, the way Datamuse ranks by
+        relatedness. Those without a vector come last, in alphabetical order.
+
+        Returns
+        -------
+        list
+            The rhyming words as str, word itself not included.
+        """
+        if self.rhyme_index is not None:
+            rhymes = sorted(r for r in self.rhyme_index.rhymes_with(word) if r in self.words_to_pos)
+            if rhymes and word in self.poetic_vectors:
+                rhymes.sort(key=lambda r: -self.poetic_vectors.similarity(word, r) if r in self.poetic_vectors else np.inf)
+            return rhymes
+        return self.datamuse.words(rel_rhy=word)
+
     def get_five_words(self, w2):
         """
         Given a seed word, finds four other words that fit the rhyme scheme of
@@ -190,9 +363,10 @@ class Limerick_Generate:
         seen_words = set([self.ps.stem(w2)])
 
         # Three connection words
-        w_response = requests.get(self.api_url, params={'rel_rhy': w2}).json()
-        rhyme_nnp = set(d['word'] for d in w_response).intersection(self.pos_to_words['NNP'])
-        # Find a word that rhymes with w2 that is a pronoun
+        w_response = self.get_rhymes(w2)
+        nnp = set(self.pos_to_words['NNP'])
+        rhyme_nnp = [r for r in w_response if r in nnp]
+        # Find a word that rhymes with w2 that is a pronoun, best ranked first
         for r in rhyme_nnp:
             if r in self.words_to_pos and self.ps.stem(r) not in seen_words:
                 w1 = r
@@ -201,8 +375,8 @@ class Limerick_Generate:
 
         # Any rhyming word
         for r in w_response:
-            if r['word'] in self.words_to_pos and self.ps.stem(r['word']) not in seen_words:
-                w5 = r['word']
+            if r in self.words_to_pos and self.ps.stem(r) not in seen_words:
+                w5 = r
                 seen_words.add(self.ps.stem(w5))
                 break
 
@@ -210,15 +384,15 @@ class Limerick_Generate:
         w4 = self.two_word_link(w2, w5, seen_words)
         seen_words.add(self.ps.stem(w4))
 
-        w3_response = requests.get(self.api_url, params={'rel_rhy': w4}).json()
+        w3_response = self.get_rhymes(w4)
         # Find word most similar to w4 that rhymes with it
         max_sim = 0
         for r in w3_response:
-            if r['word'] not in self.words_to_pos:
+            if r not in self.words_to_pos:
                 continue
-            this_sim = self.poetic_vectors.similarity(r['word'], w4)
-            if this_sim  > max_sim and self.ps.stem(r['word']) not in seen_words:
-                w3 = r['word']
+            this_sim = self.poetic_vectors.similarity(r, w4)
+            if this_sim  > max_sim and self.ps.stem(r) not in seen_words:
+                w3 = r
                 max_sim = this_sim
 
         if w5 is None or w3 is None or w1 is None:
@@ -314,55 +488,61 @@ class Limerick_Generate:
             model, the score of the line, and the line itself for the top n lines.
             The score can be indexed by [0][0].item, and the line by [0][1][1]
         """
-        tf.reset_default_graph()
-        with open(os.path.join(self.model_dir, 'config.pkl'), 'rb') as f:
-            saved_args = pickle.load(f)
-        with open(os.path.join(self.model_dir, 'words_vocab.pkl'), 'rb') as f:
-            word_keys, vocab = pickle.load(f)
-        model = Model_back(saved_args, True)
-        with tf.Session() as sess:
-            tf.global_variables_initializer().run()
-            saver = tf.train.Saver(tf.global_variables())
-            ckpt = tf.train.get_checkpoint_state(self.model_dir)
-            if ckpt and ckpt.model_checkpoint_path:
-                saver.restore(sess, ckpt.model_checkpoint_path)
-                word_pool_ind = 0
-                if state is None:
-                    state = sess.run(model.initial_state)
-                if score is None:
-                    score = np.array([[0]])
-
-                # This is where the candidate lines are generated
-                lst = search_back_meter(model, vocab, score, seq ,state, sess, 1,
-                    self.words_to_pos, self.width, self.word_pools[word_pool_ind],
-                    self.pos_to_words, template, template_sylls, self.dict_meters)
-                # Sort each candidate line by score
-                lst.sort(key=lambda x: x[0], reverse = True)
-            else:
-                raise IOError('No model checkpoint')
+        model = self.model_back
+        word_pool_ind = 0
+        if state is None:
+            state = model.zero_state
+        if score is None:
+            score = np.array([[0]])
+
+        # This is where the candidate lines are generated
+        with model.timed('search_back_meter'):
+            lst = search_back_meter(self.step_model, model.vocab, score, seq ,state, model.sess, 1,
+                self.words_to_pos, self.width, self.word_pools[word_pool_ind],
+                self.pos_to_words, template, template_sylls, self.dict_meters, self.candidates)
+        # Sort each candidate line by score
+        lst.sort(key=lambda x: x[0], reverse = True)
         return lst
 
+    def run_gen_model_back_many(self, jobs):
+        """
+        run_gen_model_back for several lines at once: the searches advance
+        level by level together and every level of all of them is one model
+        call.
+
+        Parameters
+        ----------
+        jobs : list
+            One (seq, template, template_sylls, state, score) tuple per line,
+            with the arguments run_gen_model_back takes; state and score may be
+            None.
+
+        Returns
+        -------
+        list
+            The sorted candidate lines of each job, as run_gen_model_back
+            returns them.
+        """
+        model = self.model_back
+        word_pool_ind = 0
+        lines = []
+        for seq, template, template_sylls, state, score in jobs:
+            lines.append((np.array([[0]]) if score is None else score, seq,
+                model.zero_state if state is None else state, template, template_sylls))
+
+        with model.timed('search_back_meter_many'):
+            lsts = search_back_meter_many(self.step_model, model.vocab, lines, model.sess, 1,
+                self.words_to_pos, self.width, self.word_pools[word_pool_ind],
+                self.pos_to_words, self.dict_meters, self.candidates)
+        for lst in lsts:
+            lst.sort(key=lambda x: x[0], reverse = True)
+        return lsts
+
     def get_rand_template(self, num_sylls, last_word):
         last_pos = self.words_to_pos[last_word][0]
         last_word_sylls = len(self.dict_meters[last_word][0])
         temp_len = num_sylls - last_word_sylls
         return random.choice(self.templates_dict[(last_pos, temp_len)])
-    def compute_next_state(self, state, score, seq):
-        tf.reset_default_graph()
-        with open(os.path.join(self.model_dir, 'config.pkl'), 'rb') as f:
-            saved_args = pickle.load(f)
-        with open(os.path.join(self.model_dir, 'words_vocab.pkl'), 'rb') as f:
-            word_keys, vocab = pickle.load(f)
-        model = Model_back(saved_args, True)
-        with tf.Session() as sess:
-            tf.global_variables_initializer().run()
-            saver = tf.train.Saver(tf.global_variables())
-            ckpt = tf.train.get_checkpoint_state(self.model_dir)
-            if ckpt and ckpt.model_checkpoint_path:
-                saver.restore(sess, ckpt.model_checkpoint_path)
-                word_pool_ind = 0
-                next_score, next_state=model.compute_fx(sess, vocab, score, seq, state, 1)
-        return next_score, next_state
     def gen_first_line(self, w2, num_sylls):
         def get_num_sylls(template):
             n=0
@@ -373,9 +553,9 @@ class Limerick_Generate:
         names=self.first_line_words[0]
         cities=self.first_line_words[1]
         names={x[0]:x[1] for x in names}
-        w_response = requests.get(self.api_url, params={'rel_rhy': w2}).json()
-        rhyme_names = set(d['word'] for d in w_response).intersection(names.keys())
-        rhyme_cities=set(d['word'] for d in w_response).intersection(cities)
+        w_response = self.get_rhymes(w2)
+        rhyme_names = set(w_response).intersection(names.keys())
+        rhyme_cities=set(w_response).intersection(cities)
         templates=get_first_nnp()
         possible_sentence=[]
         for name in rhyme_names:
@@ -395,6 +575,27 @@ class Limerick_Generate:
             return possible_sentence
 
 
+    def compute_next_states(self, states, scores, seqs, next_word):
+        """
+        Carries the final states of several backward lines into the line
+        before them, in one model call: feeds each line's first word and scores
+        next_word, the last word of the line before, from the resulting state.
+
+        Returns
+        -------
+        scores : list
+            The (1, 1) score each line before starts from.
+        states : list
+            The state each line before starts from.
+        """
+        model = self.model_back
+        with model.timed('compute_next_states'):
+            ids = [model.vocab[seq[0]] for seq in seqs]
+            p = np.array([np.asarray(score).item() for score in scores])
+            dist, state = self.step_model.compute_fx_batch(model.sess, p, ids, stack_states(states), 1)
+        next_scores = [np.reshape(row[model.vocab[next_word]], (1, 1)) for row in dist]
+        return next_scores, split_states(state, len(seqs))
+
     def gen_line(self, w1, template=None,num_sylls=10, state=None, score=None):
         """
         Generetes a single line, backwards from the given word, with restrictions
@@ -443,7 +644,67 @@ class Limerick_Generate:
 
         return template, lst
 
-    def gen_best_line(self, w1, pos=None, templates=None, set_of_templates=None, rand_templates=5, num_sylls=10, state=None, score=None, return_state=False):
+    def template_line(self, w1, template, num_sylls=10, state=None, score=None, return_state=False):
+        """
+        The best line gen_line finds for one (template, template info) pair of
+        gen_best_line, as the tuple gen_best_line collects, or None if the
+        template cannot be filled.
+        """
+        try:
+            t, line=self.gen_line(w1, template=template[0],num_sylls=num_sylls, state=state, score=score)
+            this_line = line[0][1][1]
+            this_score = line[0][0].item() / len(this_line)
+            if return_state:
+                return (this_line, this_score, t, template[1],  line[0][1][0][1])
+            return (this_line, this_score, t, template[1])
+        except:
+            return None
+
+    def template_lines(self, w1, templates, num_sylls=10, states=None, scores=None, return_state=False):
+        """
+        template_line for several templates at once through
+        run_gen_model_back_many, each optionally starting from its own state
+        and score. None for the templates that cannot be filled: like
+        template_line, a template whose search fails is dropped rather than
+        failing the others (all of them are None if w1 itself is unusable).
+        """
+        out = [None] * len(templates)
+        try:
+            last_word_sylls = len(self.dict_meters[w1][0])
+        except:
+            return out
+        jobs = []
+        for i, template in enumerate(templates):
+            try:
+                template_sylls = self.valid_permutation_sylls(num_sylls, template[0], last_word_sylls)
+            except:
+                continue
+            if template_sylls is not None:
+                jobs.append((i, ([w1], template[0], template_sylls,
+                    None if states is None else states[i], None if scores is None else scores[i])))
+        try:
+            lsts = self.run_gen_model_back_many([job for _, job in jobs]) if jobs else []
+        except:
+            # Find the failing templates by searching each on its own
+            lsts = []
+            for _, job in jobs:
+                try:
+                    lsts.append(self.run_gen_model_back_many([job])[0])
+                except:
+                    lsts.append([])
+        for (i, _), line in zip(jobs, lsts):
+            try:
+                this_line = line[0][1][1]
+                this_score = line[0][0].item() / len(this_line)
+            except:
+                continue
+            out[i] = (this_line, this_score, templates[i][0], templates[i][1])
+            if return_state:
+                out[i] += (line[0][1][0][1],)
+        return out
+
+    def gen_best_line(self, w1, pos=None, templates=None, set_of_templates=None, rand_templates=5, num_sylls=10, state=None, score=None, return_state=False,
+            parallel=False, score_threshold=None, time_budget=None):
         """
         Generetes a single line by choosing the best of 10 lines whose templates were randomly selected,
         backwards from the given word, with restrictions
@@ -460,6 +721,15 @@ class Limerick_Generate:
         num_sylls : int, optional
             If template is None, then a template that has a length close to the
             number of syllables required will be randomly sampled.
+        parallel : bool, optional
+            Search the templates at the same time on the worker processes of
+            start_workers (started with one per core if not running yet).
+        score_threshold : float, optional
+            With parallel, return as soon as a line scores at least this much.
+        time_budget : float, optional
+            With parallel, return the lines finished within this many seconds.
+            The searches still pending are cancelled, and those already running
+            stop at their next beam level.
 
         Returns
         -------
@@ -486,24 +756,35 @@ class Limerick_Generate:
 
         # Assign syllables to each pos in template
         lines=[]
-        for template in templates:
+        if parallel:
+            workers = self.start_workers()
+            call = self.worker_call.value
+            futures = [workers.submit(_worker_template_line, call, w1, template, num_sylls, state, score, return_state) for template in templates]
             try:
-                t, line=self.gen_line(w1, template=template[0],num_sylls=num_sylls, state=state, score=score)
-                this_line = line[0][1][1]
-                this_score = line[0][0].item() / len(this_line)
-                if return_state:
-                    lines.append((this_line, this_score, t, template[1],  line[0][1][0][1]))
-                else:
-                    lines.append((this_line, this_score, t, template[1]))
-            except:
-                continue
+                for future in concurrent.futures.as_completed(futures, timeout=time_budget):
+                    line = future.result()
+                    if line is not None:
+                        lines.append(line)
+                        if score_threshold is not None and line[1] >= score_threshold:
+                            break
+            except concurrent.futures.TimeoutError:
+                pass
+            for future in futures:
+                future.cancel()
+            with self.worker_call.get_lock():
+                self.worker_call.value += 1
+        else:
+            for template in templates:
+                line = self.template_line(w1, template, num_sylls, state, score, return_state)
+                if line is not None:
+                    lines.append(line)
         lines.sort(key=lambda x: x[1], reverse = True)
         if len(lines)==0:
             raise ValueError('No lines can be constructed')
         return lines
 
 
-    def gen_poem_independent(self, seed_word, first_line_sylls):
+    def gen_poem_independent(self, seed_word, first_line_sylls, parallel=False):
         """
         Takes a seed word and then generates five storyline words to be used as
         the last word of each line. For each line, a template is sampled and
@@ -518,6 +799,9 @@ class Limerick_Generate:
         first_line_sylls : int
             Sum of syllables contained in the first line. The syllable count for
             every other line is calculated from this value.
+        parallel : bool, optional
+            Generate the five lines at the same time, one thread each, all
+            sharing this generator's restored models.
 
         Returns
         -------
@@ -527,22 +811,24 @@ class Limerick_Generate:
         """
         five_words = self.get_five_words(seed_word)
 
-        lines = []
         third_line_sylls = first_line_sylls - 3
-        for i, w in enumerate(five_words):
-            # Set number of syllables from generated line dependent on which
-            # line is being generated
-            if i in [0, 1, 4]:
-                this_line_sylls = first_line_sylls
-            else:
-                this_line_sylls = third_line_sylls
+        # Set number of syllables from generated line dependent on which
+        # line is being generated
+        line_sylls = [first_line_sylls if i in [0, 1, 4] else third_line_sylls for i in range(len(five_words))]
 
+        def gen(w, this_line_sylls):
             t, out = self.gen_line(w, num_sylls=this_line_sylls)
 
             this_line = out[0][1][1]
             this_score = out[0][0].item() / len(this_line)
-            lines.append((this_line, this_score, t))
-        return lines
+            return (this_line, this_score, t)
+
+        if not parallel:
+            return [gen(w, n) for w, n in zip(five_words, line_sylls)]
+        # Restore the model before the threads start, so they all share it
+        self.model_back
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(five_words)) as executor:
+            return list(executor.map(gen, five_words, line_sylls))
 
 
     def gen_poem_independent_matias(self, seed_word, first_line_sylls, rand_template=5):
@@ -642,29 +928,40 @@ class Limerick_Generate:
         o2 = self.gen_best_line(five_words[1],num_sylls=second_line_sylls, set_of_templates=second_line_)
         line2 = o2[0][0]
         score2 = o2[0][1]
+        t2 = o2[0][2]
         #state2 = o2[0][1][0][1]
         o3 = self.gen_best_line(five_words[2],num_sylls=second_line_sylls - 3, set_of_templates=third_line_)
         line3 = o3[0][0]
-        score3 = o3[0][0]
-        last=[]
-        for line_4, line_5 in zip(fourth, fifth):
-            o5 = self.gen_best_line(five_words[4], num_sylls=second_line_sylls, templates=[line_5], return_state=True)
-            line5 = o5[0][0]
-            score5 = o5[0][1]#/ len(line5)
-            state5=o5[0][-1]
-            score_for4, state_for4=self.compute_next_state(state5, score5, line5)
-            o4 = self.gen_best_line(five_words[3], num_sylls=second_line_sylls-3, templates=[line_4], state=state_for4, score=score_for4)
-            try:
-                last.append((o4[0], (line5, score5, line_5[2]), o4[1]))
-            except:
-                continue
+        score3 = o3[0][1]
+        t3 = o3[0][2]
+        # Every (line 4, line 5) template pair as one pipeline: all the line 5
+        # searches together, their final states carried into the line 4
+        # searches in one call, then all the line 4 searches together
+        model = self.model_back
+        with model.timed('pairs: line 5 searches'):
+            o5 = self.template_lines(five_words[4], fifth, num_sylls=second_line_sylls, return_state=True)
+        pairs = [(line_4, o) for line_4, o in zip(fourth, o5) if o is not None]
+        if len(pairs)==0:
+            raise ValueError('no lines can be constructed')
+        with model.timed('pairs: line 5 -> 4 states'):
+            scores_for4, states_for4 = self.compute_next_states([o[4] for _, o in pairs], [o[1] for _, o in pairs],
+                [o[0] for _, o in pairs], five_words[3])
+        with model.timed('pairs: line 4 searches'):
+            o4 = self.template_lines(five_words[3], [line_4 for line_4, _ in pairs], num_sylls=second_line_sylls-3,
+                states=states_for4, scores=scores_for4)
+        for stage in ('pairs: line 5 searches', 'pairs: line 5 -> 4 states', 'pairs: line 4 searches'):
+            print('{:28} {:8.3f}s'.format(stage, model.call_times[stage][-1]))
+        # The line 4 score already includes the line 5 it was conditioned on
+        last = [(o, line5[:3], o[1]) for o, (_, line5) in zip(o4, pairs) if o is not None]
         last.sort(key=lambda x: x[2], reverse = True)
         if len(last)==0:
             raise ValueError('no lines can be constructed')
         line4=last[0][0][0]
         score4=last[0][0][1]
+        t4=last[0][0][2]
         line5=last[0][1][0]
         score5=last[0][1][1]
+        t5=last[0][1][2]
         #score_for4, state_for4=self.compute_next_state(state5, score5, line5)
         #o1 = self.run_gen_model_back(line2, t1, second_line_sylls, state=state2, score=score2)
         #t1, o1=self.gen_line(five_words[0], t_1,num_sylls=second_line_sylls, state=state_for1, score=score_for1)
@@ -743,25 +1040,23 @@ class Limerick_Generate:
         new_line_tokens = []
         for e in w.lower().split():
             new_line_tokens.append(self.enc.encode(e)[0])
-        w_response = requests.get(self.api_url, params={'rel_rhy': rhyme}).json()
-        rhyme_set = set(d['word'] for d in w_response)
+        rhyme_set = set(self.get_rhymes(rhyme)) if rhyme else set()
+        # The context is run once; each step after only feeds the word picked
+        scorer = get_scorer('117M')
+        logits, past = scorer.start([new_line_tokens])
         for i in range(len(template)):
             # Logits is the output of GPT model, encoder is used to decode the output
-            logits = score_model(context_token = [new_line_tokens])
+            if i > 0:
+                logits, past = scorer.extend(past, [[new_line_tokens[-1]]])
             POS = template[i]
-            probability = []
-            words = []
-            tokens = []
-            for index in reversed(np.argsort(logits[0])):
-                word = self.enc.decode([index]).lower().strip()
-                # Restrict the word to have the POS of the template
-                if POS in self.words_to_pos[word.lower().strip()]:
-                    # Enforce rhyme if last word
-                    if i == len(template) - 1 and rhyme and (word.lower().strip() not in rhyme_set):
-                        continue
-                    probability.append(logits[0][index])
-                    words.append(word)
-                    tokens.append(index)
+            # Restrict the word to have the POS of the template, enforce rhyme if last word
+            mask = self.gpt2_vocab.mask(POS, rhyme_set if i == len(template) - 1 and rhyme else None)
+            if i == len(template) - 1 and rhyme and not rhyme_set:
+                mask[:] = False
+            tokens = np.flatnonzero(mask)
+            tokens = tokens[np.argsort(-logits[0][tokens], kind='stable')]
+            probability = list(logits[0][tokens])
+            words = [self.gpt2_vocab.words[index] for index in tokens]
 
             # Draw from the possible words
             with tf.Session(graph=tf.Graph()) as sess:
@@ -775,7 +1070,7 @@ class Limerick_Generate:
 
         return new_line
 
-    def gen_line_gpt(self, w=None, encodes=None, default_template=None, rhyme_word=None, rhyme_set = None, search_space=100):
+    def gen_line_gpt(self, w=None, encodes=None, default_template=None, rhyme_word=None, rhyme_set = None, search_space=100, prefix=None):
         """
         Uses GPT to generate a line given the template restriction and initial sequence
         as given by the provided template, number of syllables in the line.
@@ -792,6 +1087,9 @@ class Limerick_Generate:
             If a rhyme word is passed in, the sentence generated will rhyme with this word
         rhyme_set : set, optional
             If a rhyme set is passed in, the sentence generated will end with a word in this set
+        prefix : tuple, optional
+            (next-token distribution, past) of the encodes, as returned by the scorer's
+            start or extend_prefix. Passing it in saves running the encodes again.
 
         Returns
         -------
@@ -811,44 +1109,53 @@ class Limerick_Generate:
         new_line = []
 
         if not rhyme_set and rhyme_word:
-            w_response = requests.get(self.api_url, params={'rel_rhy': rhyme_word}).json()
-            rhyme_set = set(d['word'] for d in w_response)
+            rhyme_set = set(self.get_rhymes(rhyme_word))
             # Include the word itself in the rhyme set
-            rhyme_set.add(rhyme)
+            rhyme_set.add(rhyme_word)
 
-        # Tuple format: original word array, encode array, log probability of this sentence
+        # The line starts from the words and encodes of w, or from encodes
         if w:
-            sentences = [(w.lower().split(), [], 0)]
-            for e in w.lower().split():
-                sentences[0][1].append(self.enc.encode(e)[0])
+            start_words = w.lower().split()
+            start_tokens = [self.enc.encode(e)[0] for e in start_words]
         if encodes:
-            sentences = [([], encodes, 0)]
+            start_words = []
+            start_tokens = list(encodes)
+        # Incremental decoding: the context is run once, then each step feeds
+        # one token per sentence against the kept keys/values (past) of its row.
+        # The context's keys/values are shared by all rows, past only holds the line
+        scorer = get_scorer('117M')
+        if prefix is None:
+            prefix = scorer.start([start_tokens])
+        logits, prefix_past = prefix
+        past = None
+        # Sentences are BeamHistory nodes (node 0 is the context) with their log
+        # probability; the kept ones are cut from a (sentences x vocab) matrix
+        beam = Beam(search_space)
+        history = BeamHistory()
+        nodes = np.zeros(1, dtype=np.int64)
+        scores = np.zeros(1)
         for i in range(len(template)):
             # Logits is the output of GPT model, encoder is used to decode the output
-            logits = score_model(context_token = [s[1] for s in sentences])
+            if i > 0:
+                if past is not None:
+                    past = scorer.reorder(past, beam.parents)
+                logits, past = scorer.extend(past, beam.tokens[:, None], prefix=prefix_past)
             POS = template[i]
-
-            new_sentences = []
-            # For each sentence, calculate probability of a new word
-            for j in range(len(sentences)):
-                # There might be duplicate words such as "And" and " and" and we only need one
-                for index in range(len(logits[j])):
-                    word = self.enc.decode([index]).lower().strip()
-                    # Restrict the word to have the POS of the template
-                    if POS in self.words_to_pos[word]:
-                        # Enforce rhyme if last word
-                        if i == len(template) - 1 and rhyme_set and (word.lower().strip() not in rhyme_set):
-                            continue
-                        # Add candidate sentence to new array
-                        new_sentences.append(
-                            (sentences[j][0] + [word],
-                            sentences[j][1] + [index],
-                            sentences[j][2] + np.log(logits[j][index])))
-
-            # Get the most probable N sentences by sorting the list according to probability
-            sentences = heapq.nsmallest(min(len(new_sentences), search_space), new_sentences, key=lambda x: -x[2])
-        print(sentences[0][0])
-        return sentences[0]
+            # Restrict the word to have the POS of the template, enforce rhyme if last word
+            allowed = np.flatnonzero(self.gpt2_vocab.mask(POS, rhyme_set if i == len(template) - 1 else None))
+
+            # Log probability of every sentence followed by every allowed word,
+            # flattened sentence-major; the best search_space are kept
+            new_scores = scores[:, None] + np.log(logits[:, allowed])
+            beam.select(new_scores.ravel(), np.repeat(np.arange(len(scores)), len(allowed)), np.tile(allowed, len(scores)))
+            nodes = history.add(nodes[beam.parents], beam.tokens)
+            scores = beam.scores
+
+        # The kept sentences are in ascending order, the best is the last
+        tokens = [int(t) for t in history.paths(nodes[-1:], len(template))[0]]
+        best = (start_words + [self.gpt2_vocab.words[t] for t in tokens], start_tokens + tokens, scores[-1])
+        print(best[0])
+        return best
 
     def gen_poem_gpt(self, rhyme1, rhyme2, default_templates, first_line_sylls, story_line=False, prompt_length=100, save_as_pickle=False, search_space=100):
         """
@@ -878,6 +1185,8 @@ class Limerick_Generate:
             Search space of the sentence finding algorithm.
             The larger the search space, the more sentences the network runs
             in parallel to find the best one with the highest score.
+            The prompt is run once and shared by every sentence, so the same
+            search space is affordable for all four lines.
 
         Returns
         -------
@@ -888,10 +1197,8 @@ class Limerick_Generate:
             five_words = ('joan', 'loan', 'glue', 'tissue', 'bone')
         else:
             # Get the rhyme sets
-            w1_response = requests.get(self.api_url, params={'rel_rhy': rhyme1}).json()
-            w2_response = requests.get(self.api_url, params={'rel_rhy': rhyme2}).json()
-            r1_set = set(d['word'] for d in w1_response)
-            r2_set = set(d['word'] for d in w2_response)
+            r1_set = set(self.get_rhymes(rhyme1))
+            r2_set = set(self.get_rhymes(rhyme2))
 
             # Include the word itself in the rhyme set
             r1_set.add(rhyme1)
@@ -915,19 +1222,22 @@ class Limerick_Generate:
                 pickle.dump(prompt, f)
             return
 
-        # Search space is set to decay because the more sentences we run, the longer the prompt
-        search_space_coef = [1, 1, 0.5, 0.25]
+        # The prompt is run once; after each line only its new tokens are appended
+        scorer = get_scorer('117M')
+        prefix = scorer.start([prompt])
 
-        if not story_line:
-            for i in range(4):
+        for i in range(4):
+            if not story_line:
                 rhyme_set = r1_set if (i == 0 or i == 3) else r2_set
-                new_sentence = self.gen_line_gpt(w=None, encodes=prompt, default_template = default_templates[i], rhyme_set = rhyme_set, search_space = int(search_space * search_space_coef[i]))
-                prompt += new_sentence[1]
+            else:
+                rhyme_set = [five_words[i+1]]
+            new_sentence = self.gen_line_gpt(w=None, encodes=prompt, default_template = default_templates[i], rhyme_set = rhyme_set, search_space = search_space, prefix = prefix)
+            # The sentence's encodes start with the prompt; no line follows the last one
+            if i < 3:
+                prefix = scorer.extend_prefix(prefix[1], new_sentence[1][len(prompt):])
+            prompt = new_sentence[1]
+            if not story_line:
                 rhyme_set.discard(new_sentence[0][-1])
-        else:
-            for i in range(4):
-                new_sentence = self.gen_line_gpt(w=None, encodes=prompt, default_template = default_templates[i], rhyme_set = [five_words[i+1]], search_space = int(search_space * search_space_coef[i]))
-                prompt += new_sentence[1]
 
     def gen_line_with_template(self, prompt, template, num):
         """
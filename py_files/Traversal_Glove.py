@@ -9,15 +9,18 @@ from gensim.parsing.preprocessing import remove_stopwords
 from nltk.corpus import wordnet as wn
 import os
 from six.moves import cPickle
-import requests
+from .datamuse import get_client
 from .functions import *
 
 class Meta_Poetry_Glove:
     punct = re.compile(r'[^\w\s]')
     ps = PorterStemmer()
 
-    def __init__(self, wv_file=None, wv=None):
+    def __init__(self, wv_file=None, wv=None, datamuse=None):
         self.already_seen = set()
+        # datamuse.DatamuseClient to query through, e.g. Limerick_Generate.datamuse;
+        # by default the process-wide client on the shared disk cache
+        self.datamuse = datamuse if datamuse is not None else get_client()
         if wv_file is None and wv is None:
             raise ValueError('Must specify word vectors')
 
@@ -225,7 +228,7 @@ class Meta_Poetry_Glove:
 
     def get_five_words(self, w2):
         # three connection words
-        w_response = requests.get('https://api.datamuse.com/words', params={'rel_rhy': w2}).json()
+        w_response = self.datamuse.query(rel_rhy=w2)
 
         if len(w_response) < 2:
             raise ValueError('Cannot generate limkerick using ', w2)
@@ -235,7 +238,7 @@ class Meta_Poetry_Glove:
 
         w1 = w_response[1]['word']
 
-        w3_response = requests.get('https://api.datamuse.com/words', params={'rel_rhy': w4}).json()
+        w3_response = self.datamuse.query(rel_rhy=w4)
 
         if len(w3_response) < 1:
             raise ValueError('Cannot generate limkerick using ', w2)
@@ -0,0 +1,73 @@
+import numpy as np
+
+'''fixed-capacity beam used by the searches in functions.py in place of a queue.PriorityQueue per level'''
+'''a level is held as parallel arrays (score, parent row in the level before, token id), so cutting it to the beam width is one top-k over all the children'''
+'''there is no lock taken per put/get, and equal scores never fall through to comparing the LSTM states stored next to them'''
+
+class Beam():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.scores = np.zeros(0)
+        self.parents = np.zeros(0, dtype=np.int64)
+        self.tokens = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def select(self, scores, parents, tokens):
+        '''keeps the capacity best of a level's children, given as parallel arrays'''
+        '''the kept rows are in ascending score order, the order the priority queue handed them out; parents doubles as each row's slot in the parent level's row-stacked state'''
+        '''returns the indices of the kept children so the caller can gather anything else it holds per child'''
+        scores = np.asarray(scores)
+        keep = np.arange(len(scores))
+        if(len(scores) > self.capacity):
+            keep = np.argpartition(scores, len(scores) - self.capacity)[len(scores) - self.capacity:]
+        keep = keep[np.argsort(scores[keep], kind='stable')]
+        self.scores = scores[keep]
+        self.parents = np.asarray(parents, dtype=np.int64)[keep]
+        self.tokens = np.asarray(tokens, dtype=np.int64)[keep]
+        return keep
+
+class BeamHistory():
+    '''every hypothesis a search has made, stored once as a node: parent node, token id and a rolling hash of the path'''
+    '''node 0 is the sequence the search started from; a hypothesis is just a node id, its words are only rebuilt by following the parents when a line is finished'''
+    '''the hash of a child is hash(parent) * HASH_MULT + token + 1 (mod 2**64), so checking a branch was not explored before costs one multiply-add instead of hashing its whole word tuple'''
+    HASH_MULT = np.uint64(1000003)
+
+    def __init__(self, capacity=1024):
+        self.parents = np.zeros(capacity, dtype=np.int64)
+        self.tokens = np.zeros(capacity, dtype=np.int64)
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.size = 1
+
+    def child_hashes(self, parents, tokens):
+        '''the hashes the given children would get, without adding them'''
+        tokens = np.asarray(tokens, dtype=np.uint64)
+        return np.atleast_1d(self.hashes[parents]) * self.HASH_MULT + tokens + np.uint64(1)
+
+    def add(self, parents, tokens):
+        '''appends one node per (parent, token) pair and returns their ids'''
+        parents = np.asarray(parents, dtype=np.int64)
+        n = len(parents)
+        if(self.size + n > len(self.parents)):
+            capacity = max(2 * len(self.parents), self.size + n)
+            for name in ('parents', 'tokens', 'hashes'):
+                array = getattr(self, name)
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                setattr(self, name, grown)
+        ids = np.arange(self.size, self.size + n)
+        self.hashes[ids] = self.child_hashes(parents, tokens)
+        self.parents[ids] = parents
+        self.tokens[ids] = tokens
+        self.size += n
+        return ids
+
+    def paths(self, nodes, depth):
+        '''(len(nodes), depth) array of the tokens added on the way to each node, oldest first'''
+        out = np.zeros((len(nodes), depth), dtype=np.int64)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        for j in range(depth - 1, -1, -1):
+            out[:, j] = self.tokens[nodes]
+            nodes = self.parents[nodes]
+        return out
@@ -0,0 +1,66 @@
+import collections
+import numpy as np
+
+'''which vocab ids a template slot may take, worked out once when the models are loaded instead of at every beam level'''
+
+def read_meter_dict(fname):
+    '''cmudict file -> word to its list of stress strings ('1'/'0' per syllable), the same dict Limerick_Generate keeps as dict_meters'''
+    dict_meters = {}
+    with open(fname) as f:
+        for line in f:
+            if(";;;" in line):
+                continue
+            line = line.rstrip("\n").split()
+            word = line[0].lower()
+            if("(" in word and ")" in word):
+                word = word[:-3]
+            chars = ""
+            for phone in line[1:]:
+                for ch in phone:
+                    if(ch in "012"):
+                        chars += "1" if ch == "2" else ch
+            if(word not in dict_meters): #MULTIPLE PRONUNCIATIONS OF A WORD
+                dict_meters[word] = [chars]
+            elif(chars not in dict_meters[word]):
+                dict_meters[word] += [chars]
+    dict_meters[','] = ['']
+    dict_meters['.'] = ['']
+    return dict_meters
+
+class CandidateIndex():
+    def __init__(self, PartOfSpeachSet, vocab, dictSyllables=None):
+        '''PartOfSpeachSet is postag_dict[1] (pos -> words), vocab the word -> id dict of words_vocab.pkl, dictSyllables the cmudict meters'''
+        '''index[pos] holds every in-vocab word of the pos, index[(pos, sylls)] those whose first pronunciation has sylls syllables'''
+        '''commas and full stops fit any syllable count, as in the searches, so they are added to every (pos, sylls) entry of their pos'''
+        self.index = {}
+        for pos, pos_words in PartOfSpeachSet.items():
+            words = sorted(set(word for word in pos_words if word in vocab))
+            self.index[pos] = self.entry(words, vocab)
+            if(dictSyllables is None):
+                continue
+            by_sylls = collections.defaultdict(list)
+            any_sylls = []
+            for word in words:
+                if(word not in dictSyllables):
+                    continue
+                if(word in ('.', ',')):
+                    any_sylls.append(word)
+                else:
+                    by_sylls[len(dictSyllables[word][0])].append(word)
+            for sylls, sylls_words in by_sylls.items():
+                self.index[(pos, sylls)] = self.entry(sylls_words + any_sylls, vocab)
+            '''a slot asking for a count no word of the pos has still admits the punctuation'''
+            self.index[(pos, None)] = self.entry(any_sylls, vocab)
+
+    @staticmethod
+    def entry(words, vocab):
+        '''(words, ids, lengths): lengths are the character counts the searches give a length bonus for'''
+        return words, np.array([vocab[word] for word in words], dtype=np.int32), np.array([len(word) for word in words])
+
+    def get(self, pos, sylls=None, meter=False):
+        '''(words, ids, lengths) for a template slot; with meter=True only the words with sylls syllables, as search_*_meter require'''
+        if(not meter):
+            return self.index.get(pos, self.entry([], {}))
+        if((pos, sylls) in self.index):
+            return self.index[(pos, sylls)]
+        return self.index.get((pos, None), self.entry([], {}))
@@ -0,0 +1,168 @@
+import os
+import json
+import atexit
+import threading
+import argparse
+import urllib.parse
+import http.server
+
+import requests
+
+from .state_cache import StateCache
+
+'''one client for every Datamuse query still made (rel_rhy, ...), with a persistent LRU cache of the responses in front of a pluggable backend'''
+'''backends: HTTPBackend (api.datamuse.com, or a local stand-in server started with serve()) and SnapshotBackend (a prebuilt file, for air-gapped hosts)'''
+'''the cache file and the snapshot file have the same format, {query key: response}, so a saved cache is a snapshot'''
+
+DATAMUSE_URL = 'https://api.datamuse.com/words'
+DATAMUSE_CACHE = 'py_files/saved_objects/datamuse_cache.json'
+
+def query_key(params):
+    '''the same key for the same query whatever order its params were given in'''
+    return urllib.parse.urlencode(sorted(params.items()))
+
+def read_snapshot(path):
+    with open(path) as f:
+        return json.load(f)
+
+def write_snapshot(path, responses):
+    '''written to a temporary file first, so a crash never leaves half a cache'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(responses, f)
+    os.replace(tmp, path)
+
+class HTTPBackend():
+    def __init__(self, url=DATAMUSE_URL, timeout=10):
+        '''url of the /words endpoint; every query goes over one pooled requests.Session'''
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def query(self, params):
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+class SnapshotBackend():
+    def __init__(self, path):
+        '''answers from a file written by DatamuseClient.save; a query it does not hold gets the empty response'''
+        self.responses = read_snapshot(path)
+
+    def query(self, params):
+        return self.responses.get(query_key(params), [])
+
+    def close(self):
+        pass
+
+def make_backend(source):
+    '''an http(s) url -> HTTPBackend, anything else is taken as a snapshot file'''
+    if source.startswith('http://') or source.startswith('https://'):
+        return HTTPBackend(source)
+    return SnapshotBackend(source)
+
+class DatamuseClient():
+    def __init__(self, backend=None, cache_file=None, maxsize=20000, save_every=100):
+        '''backend defaults to api.datamuse.com; cache_file (optional) is loaded now and rewritten every save_every misses, on close() and at exit'''
+        self.backend = backend if backend is not None else HTTPBackend()
+        self.cache_file = cache_file
+        self.cache = StateCache(maxsize)
+        self.save_every = save_every
+        '''misses since the cache file was last written'''
+        self.unsaved = 0
+        self.unsaved_lock = threading.Lock()
+        if cache_file is not None:
+            if os.path.exists(cache_file):
+                for key, response in read_snapshot(cache_file).items():
+                    self.cache.put(key, response)
+            atexit.register(self.flush)
+
+    def query(self, **params):
+        '''the Datamuse response (list of {'word': ..., ...} dicts) for params, e.g. query(rel_rhy='cat')'''
+        key = query_key(params)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.backend.query(params)
+            self.cache.put(key, response)
+            with self.unsaved_lock:
+                self.unsaved += 1
+                due = self.unsaved >= self.save_every
+            if due:
+                self.flush()
+        return response
+
+    def words(self, **params):
+        '''just the words of query(**params), in Datamuse's order'''
+        return [d['word'] for d in self.query(**params)]
+
+    def save(self, path):
+        '''writes the cached responses, least recently used first; the file also works as a SnapshotBackend'''
+        with self.cache.lock:
+            responses = dict(self.cache.entries)
+        write_snapshot(path, responses)
+
+    def flush(self):
+        '''writes the cache file if there are misses it does not hold yet'''
+        with self.unsaved_lock:
+            if self.cache_file is None or self.unsaved == 0:
+                return
+            self.unsaved = 0
+        self.save(self.cache_file)
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+'''one client per (source, cache file), so every user of Datamuse in a process shares its cache'''
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(source=DATAMUSE_URL, cache_file=DATAMUSE_CACHE):
+    with clients_lock:
+        if (source, cache_file) not in clients:
+            clients[(source, cache_file)] = DatamuseClient(make_backend(source), cache_file)
+        return clients[(source, cache_file)]
+
+def serve(snapshot=None, port=8000, rhyme_index=None):
+    '''a local stand-in for the /words endpoint: answers from snapshot (a saved cache), and rel_rhy queries it lacks from rhyme_index (rhymes.RhymeIndex)'''
+    '''point a client at it with DatamuseClient(HTTPBackend('http://localhost:<port>/words'))'''
+    responses = read_snapshot(snapshot) if snapshot is not None else {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            key = query_key(params)
+            if key in responses:
+                body = responses[key]
+            elif rhyme_index is not None and list(params) == ['rel_rhy']:
+                body = [{'word': word} for word in sorted(rhyme_index.rhymes_with(params['rel_rhy']))]
+            else:
+                body = []
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Datamuse /words endpoint.')
+    parser.add_argument('--snapshot', help='a cache file saved by DatamuseClient')
+    parser.add_argument('--cmudict', help='answer rel_rhy queries missing from the snapshot from this cmudict file')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    rhyme_index = None
+    if args.cmudict is not None:
+        from .rhymes import RhymeIndex
+        rhyme_index = RhymeIndex(args.cmudict)
+    serve(args.snapshot, args.port, rhyme_index)
@@ -0,0 +1,86 @@
+import os
+import json
+import pickle
+import struct
+import argparse
+import numpy as np
+
+'''single-file export of a word-level RNN checkpoint: config, vocab and the rnnlm weights as flat arrays'''
+'''layout: MAGIC, format version (uint32), header length (uint64), the json header, then each array raw and 64-byte aligned'''
+'''the header holds the config, the words in id order and, per array, its dtype, shape and offset, so load_export can np.memmap every array read-only'''
+'''worker processes loading the same file share its pages, and nothing is parsed or restored at start-up'''
+
+MAGIC = b'POETIXRNN\0'
+VERSION = 1
+ALIGN = 64
+
+def export_model(model_dir, out_path):
+    '''reads config.pkl, words_vocab.pkl and the latest checkpoint of model_dir and writes them to out_path'''
+    from .model_numpy import load_checkpoint_weights
+    with open(os.path.join(model_dir, 'config.pkl'), 'rb') as f:
+        saved_args = pickle.load(f)
+    with open(os.path.join(model_dir, 'words_vocab.pkl'), 'rb') as f:
+        word_keys, vocab = pickle.load(f)
+    words = sorted(vocab, key=vocab.get)
+    if [vocab[word] for word in words] != list(range(len(words))):
+        raise ValueError('Vocab ids of {} are not 0..n-1'.format(model_dir))
+
+    weights = load_checkpoint_weights(model_dir)
+    arrays = {}
+    offset = 0
+    for name in sorted(weights):
+        array = np.ascontiguousarray(weights[name], dtype=np.float32)
+        arrays[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'version': VERSION, 'config': vars(saved_args), 'words': words, 'arrays': arrays}).encode('utf-8')
+
+    prefix = len(MAGIC) + struct.calcsize('<IQ') + len(header)
+    data_start = -(-prefix // ALIGN) * ALIGN
+    with open(out_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<IQ', VERSION, len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_start - prefix))
+        for name in sorted(weights):
+            array = np.ascontiguousarray(weights[name], dtype=np.float32)
+            f.seek(data_start + arrays[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+def read_header(path):
+    '''the json header of an export and the file offset its arrays start at'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError('Not a model export: {}'.format(path))
+        version, header_len = struct.unpack('<IQ', f.read(struct.calcsize('<IQ')))
+        if version != VERSION:
+            raise IOError('Unsupported model export version {} in {}'.format(version, path))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    prefix = len(MAGIC) + struct.calcsize('<IQ') + header_len
+    return header, -(-prefix // ALIGN) * ALIGN
+
+def load_export(path):
+    '''(saved_args, word_keys, vocab, weights) of an export; weights are read-only memmaps into the file'''
+    header, data_start = read_header(path)
+    saved_args = argparse.Namespace(**header['config'])
+    word_keys = header['words']
+    vocab = {word: i for i, word in enumerate(word_keys)}
+    weights = {}
+    for name, spec in header['arrays'].items():
+        weights[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r',
+                                  offset=data_start + spec['offset'], shape=tuple(spec['shape']))
+    return saved_args, word_keys, vocab, weights
+
+def is_export(path):
+    '''True for a file written by export_model, False for a checkpoint directory'''
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a word-level RNN checkpoint directory to one memory-mappable file.')
+    parser.add_argument('model_dir', help='directory with config.pkl, words_vocab.pkl and the checkpoint')
+    parser.add_argument('out_path', help='file to write, e.g. py_files/models/all_combined_back.rnn')
+    args = parser.parse_args()
+    export_model(args.model_dir, args.out_path)
@@ -0,0 +1,66 @@
+import collections
+import numpy as np
+
+from .rhymes import rhyme_class
+
+'''tables over the GPT-2 BPE vocabulary, worked out once so a template step of gen_line_gpt is a mask over the logits rather than a decode and a dict lookup per token'''
+'''a token stands for the word its decoding gives, lowercased and stripped, the same normalisation the generation loops used'''
+
+class GPT2Vocab():
+    def __init__(self, enc, words_to_pos, dict_meters=None, pronunciations=None):
+        '''enc is the GPT-2 encoder, words_to_pos postag_dict[2], dict_meters the cmudict meters, pronunciations rhymes.read_pronunciations of cmudict'''
+        '''words[t] is the normalised word of token t, pos_mask[t, pos_index[pos]] whether words_to_pos lists pos for it'''
+        '''syllables[t] is the syllable count of its first pronunciation, rhyme_classes[t] an id of that pronunciation's rhyme class; -1 where cmudict does not have the word'''
+        self.n_vocab = len(enc.encoder)
+        self.words = [enc.decode([token]).lower().strip() for token in range(self.n_vocab)]
+        self.word_tokens = collections.defaultdict(list)
+        for token, word in enumerate(self.words):
+            self.word_tokens[word].append(token)
+
+        self.pos_tags = sorted(set(pos for word in self.word_tokens for pos in words_to_pos.get(word, ())))
+        self.pos_index = {pos: i for i, pos in enumerate(self.pos_tags)}
+        self.pos_mask = np.zeros((self.n_vocab, len(self.pos_tags)), dtype=bool)
+        for word, tokens in self.word_tokens.items():
+            for pos in words_to_pos.get(word, ()):
+                self.pos_mask[tokens, self.pos_index[pos]] = True
+
+        self.syllables = np.full(self.n_vocab, -1, dtype=np.int32)
+        if dict_meters is not None:
+            for word, tokens in self.word_tokens.items():
+                if word in dict_meters:
+                    self.syllables[tokens] = len(dict_meters[word][0])
+
+        self.rhyme_classes = np.full(self.n_vocab, -1, dtype=np.int32)
+        self.class_ids = {}
+        if pronunciations is not None:
+            for word, tokens in self.word_tokens.items():
+                if word not in pronunciations:
+                    continue
+                c = rhyme_class(pronunciations[word][0])
+                if c is not None:
+                    self.rhyme_classes[tokens] = self.class_ids.setdefault(c, len(self.class_ids))
+
+    def word_mask(self, words):
+        '''True for the tokens whose word is one of words'''
+        mask = np.zeros(self.n_vocab, dtype=bool)
+        for word in words:
+            mask[self.word_tokens.get(word, [])] = True
+        return mask
+
+    def rhyme_mask(self, token):
+        '''True for the tokens in the rhyme class of token, none for a token cmudict does not have'''
+        if self.rhyme_classes[token] < 0:
+            return np.zeros(self.n_vocab, dtype=bool)
+        return self.rhyme_classes == self.rhyme_classes[token]
+
+    def mask(self, pos, rhyme_set=None, sylls=None):
+        '''the tokens a template slot admits: words of pos, if given ending in rhyme_set and of sylls syllables'''
+        if pos in self.pos_index:
+            mask = self.pos_mask[:, self.pos_index[pos]].copy()
+        else:
+            mask = np.zeros(self.n_vocab, dtype=bool)
+        if rhyme_set:
+            mask &= self.word_mask(rhyme_set)
+        if sylls is not None:
+            mask &= self.syllables == sylls
+        return mask
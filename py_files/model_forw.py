@@ -1,17 +1,29 @@
 import tensorflow as tf
 from tensorflow.contrib import rnn
 from tensorflow.contrib import legacy_seq2seq
+from tensorflow.contrib.framework import nest
 import random
 import time
 import numpy as np
 
+from .state_cache import lookup_rows, store_rows, merge_rows
+from .model_infer import build_inference_graph, build_sequence_scorer, build_cached_scorer
+from .rnn_state import pad_sequences, take_rows, state_output
+
 '''this is the model object. it consists mostly of tensorflow variables and has a few functions for computing probabilities'''
 '''it gets called in train.py and the poem generation script'''
 
 class Model():
-    def __init__(self, args, infer=False):
+    def __init__(self, args, infer=False, inference_only=False):
         '''these arguments appear in full in train.py'''
         self.args = args
+        '''optional state_cache.StateCache consulted by compute_fx_batch, compute_fx_candidates and score_a_list, set by ModelSession'''
+        self.state_cache = None
+
+        '''generation only needs one step of the network: see model_infer.py'''
+        if inference_only:
+            build_inference_graph(self, args)
+            return
 
         '''it seems this will never happen'''
         if infer:
@@ -127,6 +139,24 @@ class Model():
         self.final_state = last_state
         self.test_final_state = test_last_state
 
+        '''batched single-step inference: one row per beam hypothesis, the batch size is left dynamic'''
+        self.beam_input = tf.placeholder(tf.int32, [None])
+        self.beam_state = nest.map_structure(lambda size: tf.placeholder(tf.float32, [None, size]), cell.state_size)
+        with tf.variable_scope('rnnlm', reuse=True):
+            beam_output, self.beam_final_state = cell(tf.nn.embedding_lookup(self.W, self.beam_input), self.beam_state)
+        beam_logits = (tf.matmul(beam_output, softmax_w) + softmax_b) / self.temp
+        beam_normaliser = tf.reduce_logsumexp(beam_logits, axis=1, keepdims=True)
+        self.beam_log_probs = beam_logits - beam_normaliser
+
+        '''the same step scored only on a set of candidate ids: a gather of softmax_w columns plus the exact normaliser'''
+        self.beam_candidates = tf.placeholder(tf.int32, [None])
+        candidate_logits = (tf.matmul(beam_output, tf.gather(softmax_w, self.beam_candidates, axis=1)) + tf.gather(softmax_b, self.beam_candidates)) / self.temp
+        self.beam_candidate_log_probs = candidate_logits - beam_normaliser
+        build_cached_scorer(self, args, beam_output, softmax_w, softmax_b, beam_normaliser)
+
+        '''padded batches of whole sequences, for score_batch'''
+        build_sequence_scorer(self, cell, softmax_w, softmax_b)
+
         '''the optimizer'''
         self.lr = tf.Variable(0.0, trainable=False)
         optimizer = tf.train.AdamOptimizer(self.lr)
@@ -156,37 +186,113 @@ class Model():
         xdata = xdata[:-1]
 
         prob = 0
-        state = sess.run(self.initial_state)
+        start, hit = 0, None
+        if self.state_cache is not None:
+            '''resume from the longest prefix of seq already scored'''
+            start, hit = self.state_cache.longest_prefix(temp, tensor.tolist())
+        if hit is not None:
+            prob, state = hit
+        else:
+            state = sess.run(self.initial_state)
 
         input = np.zeros((1,1))
         
-        for i in range(n_words-1):
+        for i in range(start, n_words-1):
             input[0,0] = xdata[i]
             feed = {self.input_data: input, self.initial_state: state, self.temp : temp}
             [probs, state] = sess.run([self.probs, self.final_state],
                                         feed)
             prob += np.log(probs.squeeze()[ydata[i]])
+            if self.state_cache is not None:
+                self.state_cache.put(('score_a_list', temp, tuple(tensor[:i+2].tolist())), (prob, state))
         return prob, state
 
         
+    def score_batch(self, sess, vocab, seqs, temp = 1):
+        '''score_a_list for many sequences in one sess.run: the sequences are padded and unrolled together from the initial state'''
+        '''returns each sequence's log-prob and the row-stacked final states, row i being what score_a_list(sess, vocab, seqs[i]) returns'''
+
+        inputs, targets, lengths = pad_sequences(vocab, seqs)
+
+        feed = {self.score_inputs: inputs, self.score_targets: targets, self.score_lengths: lengths, self.temp : temp}
+
+        [probs, state] = sess.run([self.score_log_probs, self.score_final_state],
+                                    feed)
+
+        if self.state_cache is not None:
+            '''so score_a_list and a later score_batch resume from these lines'''
+            for row, seq in enumerate(seqs):
+                if lengths[row] > 0:
+                    self.state_cache.put(('score_a_list', temp, tuple(vocab[w] for w in seq)), (probs[row], take_rows(state, [row])))
+        return probs, state
+
     def compute_fx(self, sess, vocab, p, x, state, temp):
         '''produce the (new) probability distribution given a session, vocab, previous prob. distribution, sequence, temperature, and state'''
 
-        input = np.array([[vocab[x[-1]]]])
-
         if state is None:
-            state = sess.run(model.initial_state)
-        
-        feed = {self.input_data: input, self.initial_state: state, self.temp : temp}
-        
-        [probs, state] = sess.run([self.probs, self.final_state],
-                                    feed)
+            state = sess.run(self.initial_state)
+
+        '''a one-row compute_fx_batch, so the same word fed from the same state comes from the cache'''
+        log_probs, state = self.compute_fx_batch(sess, 0., [vocab[x[-1]]], state, temp)
         
-        dist = p.squeeze() + np.log(probs.squeeze())        
+        dist = p.squeeze() + log_probs[0]
         
         return dist.squeeze(), state
     
     
+    def compute_fx_batch(self, sess, p, ids, state, temp=1):
+        '''compute_fx for a whole beam level in one sess.run'''
+        '''p holds the running log-prob of each row, ids the vocab id each row feeds next, state the row-stacked states (see rnn_state.stack_states)'''
+        '''returns the (rows, vocab) distributions and the row-stacked new state'''
+
+        if self.state_cache is not None:
+            log_probs, state = self.cached_run(sess, self.mixed_log_probs, ids, state, temp)
+        else:
+            feed = {self.beam_input: ids, self.beam_state: state, self.temp : temp}
+
+            [log_probs, state] = sess.run([self.beam_log_probs, self.beam_final_state],
+                                        feed)
+
+        dist = np.reshape(p, (-1, 1)) + log_probs
+
+        return dist, state
+
+
+    def compute_fx_candidates(self, sess, p, ids, state, cand_ids, temp=1):
+        '''compute_fx_batch restricted to the columns in cand_ids: returns (rows, len(cand_ids)) scores and the row-stacked new state'''
+        '''only the gather is restricted: the exact log normaliser still takes the full-vocab projection of every row run through the cell'''
+        '''with the state cache on, rows it already holds reuse their cached normaliser and skip that projection (see cached_run)'''
+
+        if self.state_cache is not None:
+            log_probs, state = self.cached_run(sess, self.mixed_candidate_log_probs, ids, state, temp, {self.beam_candidates: cand_ids})
+        else:
+            feed = {self.beam_input: ids, self.beam_state: state, self.beam_candidates: cand_ids, self.temp : temp}
+
+            [log_probs, state] = sess.run([self.beam_candidate_log_probs, self.beam_final_state],
+                                        feed)
+
+        dist = np.reshape(p, (-1, 1)) + log_probs
+
+        return dist, state
+
+
+    def cached_run(self, sess, log_probs, ids, state, temp, feed=None):
+        '''a beam step in one sess.run, only the rows the state cache lacks going through the cell and the full-vocab normaliser'''
+        '''log_probs is mixed_log_probs or mixed_candidate_log_probs; returns its rows and the new state, both in the order of ids'''
+
+        keys, missing, hit, hit_state, hit_norms = lookup_rows(self.state_cache, temp, ids, state)
+        feed = dict(feed or {})
+        feed.update({self.beam_input: np.asarray(ids)[missing], self.beam_state: take_rows(state, missing),
+            self.cached_output: state_output(hit_state), self.cached_normaliser: hit_norms, self.temp : temp})
+
+        [log_probs, miss_state, miss_norms] = sess.run([log_probs, self.beam_final_state, self.beam_normaliser],
+                                    feed)
+
+        store_rows(self.state_cache, keys, missing, miss_state, miss_norms)
+        log_probs = merge_rows(missing, hit, log_probs[:len(missing)], log_probs[len(missing):])
+        return log_probs, merge_rows(missing, hit, miss_state, hit_state)
+
+
     def beamscore(self, sess, vocab, p, x, y, state, temp):
         """Returns log p(y+x), and state after prediction,"""
         """Given a target y and sequence up through x and its prob and its state"""
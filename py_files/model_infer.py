@@ -0,0 +1,74 @@
+import tensorflow as tf
+from tensorflow.contrib import rnn
+from tensorflow.contrib.framework import nest
+
+'''inference-only graph for model_back.Model / model_forw.Model, built with Model(args, True, inference_only=True)'''
+'''only the embedding lookup, one cell step and the softmax are built: no loss, test decoder, summaries, optimizer or gradients'''
+'''the variables are created under the same names as in training (rnnlm/W, rnnlm/softmax_w, rnnlm/softmax_b, rnnlm/multi_rnn_cell/...), so a Saver over tf.global_variables() restores just these from the checkpoint'''
+
+CELL_FNS = {'rnn': rnn.BasicRNNCell, 'gru': rnn.GRUCell, 'lstm': rnn.BasicLSTMCell}
+
+def build_inference_graph(model, args):
+    '''sets on model every tensor score_a_list, score_batch, compute_fx_batch and compute_fx_candidates feed or fetch'''
+    '''batch size (beam width) is a dynamic dimension throughout; initial_state defaults to a single zero row'''
+    if args.model not in CELL_FNS:
+        raise Exception("model type not supported: {}".format(args.model))
+    '''dropout is 0 at inference, so the DropoutWrapper is left out; it creates no variables'''
+    model.cell = cell = rnn.MultiRNNCell([CELL_FNS[args.model](args.rnn_size) for _ in range(args.num_layers)])
+
+    model.input_data = tf.placeholder(tf.int32, [None, 1])
+    model.initial_state = nest.map_structure(
+        lambda size: tf.placeholder_with_default(tf.zeros([1, size]), [None, size]), cell.state_size)
+    model.temp = tf.placeholder_with_default(1., shape=())
+
+    with tf.variable_scope('rnnlm'):
+        '''no initializers worth keeping: every one of these is overwritten by the restore'''
+        softmax_w = tf.get_variable("softmax_w", [args.rnn_size, args.vocab_size])
+        softmax_b = tf.get_variable("softmax_b", [args.vocab_size])
+        with tf.device("/cpu:0"):
+            model.W = tf.get_variable("W", [args.vocab_size, args.embedding_dim])
+        output, model.final_state = cell(tf.nn.embedding_lookup(model.W, model.input_data[:, 0]), model.initial_state)
+
+    logits = (tf.matmul(output, softmax_w) + softmax_b) / model.temp
+    model.probs = tf.nn.softmax(logits)
+    normaliser = tf.reduce_logsumexp(logits, axis=1, keepdims=True)
+
+    '''the beam step is the same step: feeding beam_input feeds the one input column'''
+    model.beam_input = tf.reshape(model.input_data, [-1])
+    model.beam_state = model.initial_state
+    model.beam_final_state = model.final_state
+    model.beam_log_probs = logits - normaliser
+    model.beam_candidates = tf.placeholder(tf.int32, [None])
+    candidate_logits = (tf.matmul(output, tf.gather(softmax_w, model.beam_candidates, axis=1)) + tf.gather(softmax_b, model.beam_candidates)) / model.temp
+    model.beam_candidate_log_probs = candidate_logits - normaliser
+
+    build_cached_scorer(model, args, output, softmax_w, softmax_b, normaliser)
+    build_sequence_scorer(model, cell, softmax_w, softmax_b)
+
+def build_cached_scorer(model, args, output, softmax_w, softmax_b, normaliser):
+    '''the tensors a beam step partly served from the state cache feeds and fetches, in one sess.run (see state_cache.lookup_rows)'''
+    '''beam_input / beam_state carry only the rows the cache lacks, and only they pay the cell and the full-vocab normaliser (beam_normaliser)'''
+    '''cached_output / cached_normaliser carry the hit rows; mixed_log_probs and mixed_candidate_log_probs score the miss rows then the hit rows'''
+    model.beam_normaliser = normaliser
+    model.cached_output = tf.placeholder(tf.float32, [None, args.rnn_size])
+    model.cached_normaliser = tf.placeholder(tf.float32, [None, 1])
+    mixed_output = tf.concat([output, model.cached_output], axis=0)
+    mixed_normaliser = tf.concat([normaliser, model.cached_normaliser], axis=0)
+    model.mixed_log_probs = (tf.matmul(mixed_output, softmax_w) + softmax_b) / model.temp - mixed_normaliser
+    candidate_logits = (tf.matmul(mixed_output, tf.gather(softmax_w, model.beam_candidates, axis=1)) + tf.gather(softmax_b, model.beam_candidates)) / model.temp
+    model.mixed_candidate_log_probs = candidate_logits - mixed_normaliser
+
+def build_sequence_scorer(model, cell, softmax_w, softmax_b):
+    '''the tensors score_batch feeds and fetches: a padded batch of sequences unrolled from the zero state in one call'''
+    '''score_inputs / score_targets are (batch, time) ids, score_lengths the number of real steps per row; padded steps add nothing and leave the state alone'''
+    model.score_inputs = tf.placeholder(tf.int32, [None, None])
+    model.score_targets = tf.placeholder(tf.int32, [None, None])
+    model.score_lengths = tf.placeholder(tf.int32, [None])
+    zero_state = cell.zero_state(tf.shape(model.score_inputs)[0], tf.float32)
+    with tf.variable_scope('rnnlm', reuse=True) as scope:
+        outputs, model.score_final_state = tf.nn.dynamic_rnn(cell, tf.nn.embedding_lookup(model.W, model.score_inputs),
+            sequence_length=model.score_lengths, initial_state=zero_state, scope=scope)
+    logits = (tf.tensordot(outputs, softmax_w, axes=1) + softmax_b) / model.temp
+    target_log_probs = -tf.nn.sparse_softmax_cross_entropy_with_logits(labels=model.score_targets, logits=logits)
+    mask = tf.sequence_mask(model.score_lengths, tf.shape(model.score_inputs)[1], dtype=tf.float32)
+    model.score_log_probs = tf.reduce_sum(target_log_probs * mask, axis=1)
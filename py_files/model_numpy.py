@@ -0,0 +1,345 @@
+import collections
+import threading
+import numpy as np
+
+from .rnn_state import LSTMStateTuple, map_state, pad_sequences, take_rows, state_output
+from .state_cache import lookup_rows, store_rows, merge_rows
+
+'''numpy-only forward pass of the word-level rnn checkpoints, for serving'''
+'''it mirrors the inference side of model_back.Model / model_forw.Model: same compute_fx, compute_fx_batch, score_a_list and score_batch, same (dist, state) results'''
+'''there is no session, the sess argument is only kept so the search functions can call either model the same way'''
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.)
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+'''one step of each cell type, written the way tf.contrib.rnn computes it so the checkpoints give the same numbers'''
+'''every kernel is stored split into its input rows and its recurrent rows, which saves the concat'''
+
+def lstm_step(params, x, state):
+    '''rnn.BasicLSTMCell, forget_bias 1.0'''
+    w_x, w_h, b = params
+    c, h = state
+    i, j, f, o = np.split(x @ w_x + h @ w_h + b, 4, axis=1)
+    c = c * sigmoid(f + 1.) + sigmoid(i) * np.tanh(j)
+    h = np.tanh(c) * sigmoid(o)
+    return h, LSTMStateTuple(c, h)
+
+def gru_step(params, x, state):
+    '''rnn.GRUCell'''
+    gate_w_x, gate_w_h, gate_b, cand_w_x, cand_w_h, cand_b = params
+    r, u = np.split(sigmoid(x @ gate_w_x + state @ gate_w_h + gate_b), 2, axis=1)
+    c = np.tanh(x @ cand_w_x + (r * state) @ cand_w_h + cand_b)
+    h = u * state + (1 - u) * c
+    return h, h
+
+def rnn_step(params, x, state):
+    '''rnn.BasicRNNCell'''
+    w_x, w_h, b = params
+    h = np.tanh(x @ w_x + state @ w_h + b)
+    return h, h
+
+'''checkpoint variable names under rnnlm/multi_rnn_cell/cell_i/ for each cell type'''
+CELLS = {'lstm': (lstm_step, ['basic_lstm_cell/kernel', 'basic_lstm_cell/bias']),
+         'gru': (gru_step, ['gru_cell/gates/kernel', 'gru_cell/gates/bias',
+                            'gru_cell/candidate/kernel', 'gru_cell/candidate/bias']),
+         'rnn': (rnn_step, ['basic_rnn_cell/kernel', 'basic_rnn_cell/bias'])}
+
+class QuantizedMatrix():
+    '''int8 copy of a float weight matrix with one float32 scale per column, for the optional quantized mode of Model'''
+    '''x @ matrix works as with the float array: the int8 columns are dequantized a block at a time inside the matmul, so the full float matrix is never held'''
+    '''the scale of a column is its largest magnitude / 127, which factors out of the matmul: x @ (q * scale) == (x @ q) * scale'''
+    __array_ufunc__ = None
+    BLOCK = 4096
+
+    def __init__(self, w=None, q=None, scale=None):
+        if w is not None:
+            w = np.asarray(w, dtype=np.float32)
+            scale = np.abs(w).max(axis=0) / 127.
+            scale[scale == 0] = 1.
+            q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+        self.q = q
+        self.scale = scale.astype(np.float32)
+        self.shape = q.shape
+
+    @property
+    def nbytes(self):
+        return self.q.nbytes + self.scale.nbytes
+
+    def __getitem__(self, key):
+        '''row/column selection, e.g. softmax_w[:, cand_ids] in candidate_log_probs'''
+        scale = self.scale[key[1]] if isinstance(key, tuple) else self.scale
+        return QuantizedMatrix(q=self.q[key], scale=scale)
+
+    def __rmatmul__(self, x):
+        out = np.empty((x.shape[0], self.shape[1]), dtype=np.float32)
+        for start in range(0, self.shape[1], self.BLOCK):
+            end = start + self.BLOCK
+            out[:, start:end] = (x @ self.q[:, start:end].astype(np.float32)) * self.scale[start:end]
+        return out
+
+def load_checkpoint_weights(model_dir):
+    '''reads the rnnlm variables of the latest checkpoint in model_dir into a dict of arrays'''
+    '''tensorflow is imported here, once at load time, and never on the per-step path'''
+    import tensorflow as tf
+    ckpt = tf.train.get_checkpoint_state(model_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise IOError('No model checkpoint')
+    reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+    return {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+            if name.startswith('rnnlm/') and 'Adam' not in name}
+
+class Model():
+    def __init__(self, args, weights, quantize=False):
+        '''args is the saved config.pkl namespace, weights the dict from load_checkpoint_weights'''
+        '''quantize=True keeps the cell kernels and softmax_w as QuantizedMatrix (int8, per-column scales); the embedding and the biases stay float32'''
+        self.args = args
+        self.quantize = quantize
+        weight = QuantizedMatrix if quantize else (lambda w: w)
+
+        if args.model not in CELLS:
+            raise Exception("model type not supported: {}".format(args.model))
+        step_fn, names = CELLS[args.model]
+
+        '''the backward checkpoints were trained on reversed text and are fed the first word of the sequence, the forward ones the last'''
+        self.word_index = 0 if getattr(args, 'reverse', 0) else -1
+
+        self.W = np.asarray(weights['rnnlm/W'], dtype=np.float32)
+        self.softmax_w = weight(np.asarray(weights['rnnlm/softmax_w'], dtype=np.float32))
+        self.softmax_b = np.asarray(weights['rnnlm/softmax_b'], dtype=np.float32)
+
+        self.cells = []
+        input_size = self.W.shape[1]
+        for i in range(args.num_layers):
+            prefix = 'rnnlm/multi_rnn_cell/cell_%d/' % i
+            arrays = [np.asarray(weights[prefix + name], dtype=np.float32) for name in names]
+            params = []
+            for kernel, bias in zip(arrays[::2], arrays[1::2]):
+                params += [weight(kernel[:input_size]), weight(kernel[input_size:]), bias]
+            self.cells.append((step_fn, params))
+            input_size = args.rnn_size
+
+        '''log-sum-exp of the full softmax, keyed on the exact top layer output it was computed from'''
+        self.normaliser_cache = collections.OrderedDict()
+        self.normaliser_cache_size = 4096
+        self.normaliser_lock = threading.Lock()
+
+        '''optional state_cache.StateCache consulted by compute_fx_batch, compute_fx_candidates and score_a_list, set by ModelSession'''
+        self.state_cache = None
+
+    def weight_bytes(self):
+        '''memory held by the embedding, the cells and the softmax'''
+        arrays = [self.W, self.softmax_w, self.softmax_b] + [param for _, params in self.cells for param in params]
+        return sum(array.nbytes for array in arrays)
+
+    def zero_state(self, batch_size=1):
+        '''same structure as sess.run(model.initial_state)'''
+        size = self.args.rnn_size
+        if self.args.model == 'lstm':
+            return tuple(LSTMStateTuple(np.zeros((batch_size, size), np.float32), np.zeros((batch_size, size), np.float32))
+                         for _ in range(self.args.num_layers))
+        return tuple(np.zeros((batch_size, size), np.float32) for _ in range(self.args.num_layers))
+
+    def step(self, ids, state):
+        '''feeds one word id per row through every layer, returns the top layer output and the new state'''
+        x = self.W[ids]
+        new_state = []
+        for (step_fn, params), layer_state in zip(self.cells, state):
+            x, layer_state = step_fn(params, x, layer_state)
+            new_state.append(layer_state)
+        return x, tuple(new_state)
+
+    def log_probs(self, output, temp=1):
+        '''log of the next-word distribution for each row of a top layer output'''
+        return log_softmax((output @ self.softmax_w + self.softmax_b) / temp)
+
+    def log_normaliser(self, output, temp=1):
+        '''exact log-sum-exp of each row's full-vocab logits'''
+        '''a row already seen (the same state expanded again, e.g. the same suffix under another template) is served from the cache without the vocab-sized matmul'''
+        norms = np.empty(len(output), dtype=np.float32)
+        keys = [(temp, row.tobytes()) for row in output]
+        missing = []
+        with self.normaliser_lock:
+            for r, key in enumerate(keys):
+                if key in self.normaliser_cache:
+                    self.normaliser_cache.move_to_end(key)
+                    norms[r] = self.normaliser_cache[key]
+                else:
+                    missing.append(r)
+        if missing:
+            logits = (output[missing] @ self.softmax_w + self.softmax_b) / temp
+            top = logits.max(axis=1)
+            norms[missing] = top + np.log(np.exp(logits - top[:, None]).sum(axis=1))
+            with self.normaliser_lock:
+                for r in missing:
+                    self.normaliser_cache[keys[r]] = norms[r]
+                while len(self.normaliser_cache) > self.normaliser_cache_size:
+                    self.normaliser_cache.popitem(last=False)
+        return norms
+
+    def candidate_log_probs(self, output, cand_ids, temp=1):
+        '''log-probs of only the cand_ids columns: a gather of softmax_w columns plus the normaliser'''
+        logits = (output @ self.softmax_w[:, cand_ids] + self.softmax_b[cand_ids]) / temp
+        return logits - self.log_normaliser(output, temp)[:, None]
+
+    def cached_step(self, ids, state, temp):
+        '''the top layer output, new state and log normaliser of each row, only the rows the state cache lacks go through the cells'''
+        keys, missing, hit, hit_state, hit_norms = lookup_rows(self.state_cache, temp, ids, state)
+        output, miss_state = self.step(np.asarray(ids)[missing], take_rows(state, missing))
+        miss_norms = self.log_normaliser(output, temp)[:, None]
+        store_rows(self.state_cache, keys, missing, miss_state, miss_norms)
+        state = merge_rows(missing, hit, miss_state, hit_state)
+        return state_output(state), state, merge_rows(missing, hit, miss_norms, hit_norms)
+
+    def compute_fx_candidates(self, sess, p, ids, state, cand_ids, temp=1):
+        '''compute_fx_batch restricted to cand_ids; see model_back.Model.compute_fx_candidates'''
+        '''the normaliser still needs the full-vocab projection, except for rows the state cache or normaliser_cache already hold'''
+        if self.state_cache is not None:
+            output, state, norms = self.cached_step(ids, state, temp)
+            logits = (output @ self.softmax_w[:, cand_ids] + self.softmax_b[cand_ids]) / temp
+            return np.reshape(p, (-1, 1)) + logits - norms, state
+        output, state = self.step(np.asarray(ids), state)
+        dist = np.reshape(p, (-1, 1)) + self.candidate_log_probs(output, cand_ids, temp)
+        return dist, state
+
+    def compute_fx_batch(self, sess, p, ids, state, temp=1):
+        '''compute_fx for a whole beam level; see model_back.Model.compute_fx_batch'''
+        if self.state_cache is not None:
+            output, state, norms = self.cached_step(ids, state, temp)
+            logits = (output @ self.softmax_w + self.softmax_b) / temp
+            return np.reshape(p, (-1, 1)) + logits - norms, state
+        output, state = self.step(np.asarray(ids), state)
+        dist = np.reshape(p, (-1, 1)) + self.log_probs(output, temp)
+        return dist, state
+
+    def compute_fx(self, sess, vocab, p, x, state, temp):
+        '''produce the (new) probability distribution given a vocab, previous prob. distribution, sequence, temperature, and state'''
+        '''a one-row compute_fx_batch, so the same word fed from the same state comes from the cache'''
+        if state is None:
+            state = self.zero_state()
+        log_probs, state = self.compute_fx_batch(sess, 0., [vocab[x[self.word_index]]], state, temp)
+        dist = np.reshape(np.asarray(p).squeeze(), (-1, 1)) + log_probs
+        return dist.squeeze(), state
+
+    def score_a_list(self, sess, vocab, seq, temp = 1):
+        '''given a sequence, this computes the probability of the sequence conditions on the 0th word'''
+        ids = [vocab[w] for w in seq]
+        prob = 0
+        start, hit = 0, None
+        if self.state_cache is not None:
+            start, hit = self.state_cache.longest_prefix(temp, ids)
+        if hit is not None:
+            prob, state = hit
+        else:
+            state = self.zero_state()
+        for i in range(start, len(ids) - 1):
+            output, state = self.step([ids[i]], state)
+            prob += self.log_probs(output, temp)[0, ids[i + 1]]
+            if self.state_cache is not None:
+                self.state_cache.put(('score_a_list', temp, tuple(ids[:i + 2])), (prob, state))
+        return prob, state
+
+    def score_batch(self, sess, vocab, seqs, temp=1):
+        '''score_a_list for many sequences at once; see model_back.Model.score_batch'''
+        '''every step runs the whole batch, rows past their length keep their score and state'''
+        inputs, targets, lengths = pad_sequences(vocab, seqs)
+        rows = np.arange(len(seqs))
+        probs = np.zeros(len(seqs), dtype=np.float32)
+        state = self.zero_state(len(seqs))
+        for t in range(inputs.shape[1]):
+            active = t < lengths
+            output, new_state = self.step(inputs[:, t], state)
+            probs += np.where(active, self.log_probs(output, temp)[rows, targets[:, t]], 0.)
+            state = map_state(lambda new, old: np.where(active[:, None], new, old), new_state, state)
+        if self.state_cache is not None:
+            for row, seq in enumerate(seqs):
+                if lengths[row] > 0:
+                    self.state_cache.put(('score_a_list', temp, tuple(vocab[w] for w in seq)), (probs[row], take_rows(state, [row])))
+        return probs, state
+
+def compare_with_tf(model_cls, model_dir, seq, temp=1):
+    '''feeds seq through the tensorflow checkpoint and through this engine side by side'''
+    '''returns the largest absolute difference seen in the log-probs and in the states, to check the port stays within tolerance'''
+    from .model_session import ModelSession
+    tf_model = ModelSession(model_cls, model_dir)
+    np_model = ModelSession(model_cls, model_dir, engine='numpy')
+    tf_state, np_state = tf_model.zero_state, np_model.zero_state
+    max_dist = max_state = 0.
+    for word in seq:
+        ids = [tf_model.vocab[word]]
+        tf_dist, tf_state = tf_model.model.compute_fx_batch(tf_model.sess, 0., ids, tf_state, temp)
+        np_dist, np_state = np_model.model.compute_fx_batch(None, 0., ids, np_state, temp)
+        max_dist = max(max_dist, np.abs(tf_dist - np_dist).max())
+        diffs = []
+        map_state(lambda a, b: diffs.append(np.abs(a - b).max()), tf_state, np_state)
+        max_state = max(max_state, max(diffs))
+    tf_model.close()
+    return max_dist, max_state
+
+def quantization_drift(model_dir, data_dir='data/all_combined', n_tokens=2000, temp=1, data_reversed=True):
+    '''runs the float32 and the int8 model side by side over the first n_tokens of a training corpus and measures what quantizing costs'''
+    '''data_dir is a utils.TextLoader directory (data.npy ids, vocab.pkl words); data_reversed says whether data.npy was written with reverse=1, as data/all_combined was'''
+    '''returns the log-prob drift of the word that actually follows (mean, max), the per-token log-likelihood of each model, how often the two agree on the most likely next word, the weight memory and the time per step'''
+    import os
+    import time
+    import pickle
+    from .export_model import is_export, load_export
+    if is_export(model_dir):
+        args, _, vocab, weights = load_export(model_dir)
+    else:
+        with open(os.path.join(model_dir, 'config.pkl'), 'rb') as f:
+            args = pickle.load(f)
+        with open(os.path.join(model_dir, 'words_vocab.pkl'), 'rb') as f:
+            _, vocab = pickle.load(f)
+        weights = load_checkpoint_weights(model_dir)
+    with open(os.path.join(data_dir, 'vocab.pkl'), 'rb') as f:
+        data_words = pickle.load(f)
+    tokens = np.load(os.path.join(data_dir, 'data.npy'))
+    '''the model reads the text in the direction it was trained on'''
+    if data_reversed != bool(getattr(args, 'reverse', 0)):
+        tokens = tokens[::-1]
+    ids = [vocab[data_words[t]] for t in tokens[:n_tokens + 1]]
+
+    models = [Model(args, weights), Model(args, weights, quantize=True)]
+    states = [model.zero_state() for model in models]
+    seconds = [0., 0.]
+    targets = [[], []]
+    top = [[], []]
+    for i in range(len(ids) - 1):
+        for m, model in enumerate(models):
+            start = time.time()
+            output, states[m] = model.step([ids[i]], states[m])
+            log_probs = model.log_probs(output, temp)[0]
+            seconds[m] += time.time() - start
+            targets[m].append(log_probs[ids[i + 1]])
+            top[m].append(log_probs.argmax())
+    targets = np.array(targets, dtype=np.float64)
+    drift = np.abs(targets[1] - targets[0])
+    steps = max(len(ids) - 1, 1)
+    return collections.OrderedDict([
+        ('tokens', len(ids) - 1),
+        ('mean abs log-prob drift', drift.mean()),
+        ('max abs log-prob drift', drift.max()),
+        ('float32 mean log-prob', targets[0].mean()),
+        ('int8 mean log-prob', targets[1].mean()),
+        ('float32 perplexity', np.exp(-targets[0].mean())),
+        ('int8 perplexity', np.exp(-targets[1].mean())),
+        ('top-1 agreement', np.mean(np.array(top[0]) == np.array(top[1]))),
+        ('float32 weight MB', models[0].weight_bytes() / 2**20),
+        ('int8 weight MB', models[1].weight_bytes() / 2**20),
+        ('float32 ms/step', 1000 * seconds[0] / steps),
+        ('int8 ms/step', 1000 * seconds[1] / steps)])
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Log-prob drift, memory and speed of the int8 model against the float32 one.')
+    parser.add_argument('model_dir', help='checkpoint directory or export_model.py file, e.g. py_files/models/all_combined_back')
+    parser.add_argument('--data_dir', default='data/all_combined', help='TextLoader directory with data.npy and vocab.pkl')
+    parser.add_argument('--n_tokens', type=int, default=2000)
+    parser.add_argument('--data_forward', action='store_true', help='data.npy was written with reverse=0')
+    cli = parser.parse_args()
+    for label, value in quantization_drift(cli.model_dir, cli.data_dir, cli.n_tokens, data_reversed=not cli.data_forward).items():
+        print('{:26} {:12.4f}'.format(label, value))
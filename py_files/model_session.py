@@ -0,0 +1,141 @@
+import os
+import time
+import pickle
+import collections
+from contextlib import contextmanager
+
+import tensorflow as tf
+
+from .model_numpy import Model as Model_numpy, load_checkpoint_weights
+from .state_cache import StateCache
+from .export_model import is_export, load_export
+
+
+class ModelSession:
+    """
+    Long-lived handle on one of the word-level RNN checkpoints. The graph is
+    built and the checkpoint is restored exactly once; the same session is then
+    reused for every line, state computation and score until close() is called.
+
+    Parameters
+    ----------
+    model_cls : class
+        Either model_back.Model or model_forw.Model.
+    model_dir : str
+        Directory holding config.pkl, words_vocab.pkl and the checkpoint, or a
+        single file written by export_model.py, whose arrays are memory-mapped.
+    engine : str, optional
+        'tf' restores the checkpoint into a TensorFlow session. 'numpy' reads
+        the weights once and runs every step with model_numpy.Model, in which
+        case sess is None and model_cls is only used for its interface.
+        'int8' is the numpy engine with the cell kernels and softmax_w stored
+        as int8 (see model_numpy.quantization_drift for what that costs).
+    full_graph : bool, optional
+        Build the full training graph instead of the inference-only one (see
+        model_infer.py), e.g. to inspect the training ops.
+    cache_size : int, optional
+        Number of steps kept in the LRU state cache that compute_fx_batch,
+        compute_fx_candidates (and so compute_fx) and score_a_list consult.
+        An entry is one row's next state and normaliser, num_layers x 2 x
+        rnn_size float32: about 24 KB for the 3 x 1000 LSTMs, so the default
+        holds about 50 MB per session (and per gen_best_line worker).
+        0 disables it.
+    """
+
+    def __init__(self, model_cls, model_dir, engine='tf', full_graph=False, cache_size=2048):
+        if engine not in ('tf', 'numpy', 'int8'):
+            raise ValueError('Unknown engine: {}'.format(engine))
+        self.model_dir = model_dir
+        self.engine = engine
+        self.startup_times = collections.OrderedDict()
+        self.call_times = collections.defaultdict(list)
+        self.state_cache = StateCache(cache_size) if cache_size else None
+
+        start = time.time()
+        weights = None
+        if is_export(model_dir):
+            self.saved_args, self.word_keys, self.vocab, weights = load_export(model_dir)
+        else:
+            with open(os.path.join(model_dir, 'config.pkl'), 'rb') as f:
+                self.saved_args = pickle.load(f)
+            with open(os.path.join(model_dir, 'words_vocab.pkl'), 'rb') as f:
+                self.word_keys, self.vocab = pickle.load(f)
+        self.startup_times['load config/vocab'] = time.time() - start
+
+        if engine in ('numpy', 'int8'):
+            start = time.time()
+            if weights is None:
+                weights = load_checkpoint_weights(model_dir)
+            self.model = Model_numpy(self.saved_args, weights, quantize=engine == 'int8')
+            self.model.state_cache = self.state_cache
+            self.sess = None
+            self.zero_state = self.model.zero_state()
+            self.startup_times['load weights'] = time.time() - start
+            return
+
+        if weights is not None and full_graph:
+            raise ValueError('An export only holds the inference weights, it cannot fill the full graph')
+
+        start = time.time()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.model = model_cls(self.saved_args, True, inference_only=not full_graph)
+            self.model.state_cache = self.state_cache
+            init_op = tf.global_variables_initializer() if full_graph else None
+            # Only the variables this graph has are restored: the inference-only
+            # graph leaves out the optimizer slots and the training counters
+            saver = tf.train.Saver(tf.global_variables())
+        self.startup_times['build graph'] = time.time() - start
+
+        start = time.time()
+        if weights is None:
+            ckpt = tf.train.get_checkpoint_state(model_dir)
+            if not (ckpt and ckpt.model_checkpoint_path):
+                raise IOError('No model checkpoint')
+        self.sess = tf.Session(graph=self.graph)
+        if weights is not None:
+            with self.graph.as_default():
+                for var in tf.global_variables():
+                    var.load(weights[var.op.name], self.sess)
+            self.zero_state = self.sess.run(self.model.initial_state)
+            self.startup_times['load export'] = time.time() - start
+            return
+        if init_op is not None:
+            self.sess.run(init_op)
+        saver.restore(self.sess, ckpt.model_checkpoint_path)
+        self.zero_state = self.sess.run(self.model.initial_state)
+        self.startup_times['restore checkpoint'] = time.time() - start
+
+    @contextmanager
+    def timed(self, label):
+        """
+        Records the wall time of the enclosed block under label, so the cost of
+        each kind of call can be compared against the one-off startup cost.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.call_times[label].append(time.time() - start)
+
+    def timing_report(self):
+        """
+        Returns a printable breakdown of the startup cost followed by the count,
+        total and mean time of every kind of call made through this handle.
+        """
+        rows = ['{} ({}, {})'.format(os.path.basename(os.path.normpath(self.model_dir)), self.model_dir, self.engine)]
+        startup = sum(self.startup_times.values())
+        rows.append('  startup: {:8.3f}s'.format(startup))
+        for label, t in self.startup_times.items():
+            rows.append('    {:28} {:8.3f}s'.format(label, t))
+        for label, times in self.call_times.items():
+            rows.append('  {:30} {:5d} calls {:8.3f}s total {:8.4f}s/call'.format(
+                label, len(times), sum(times), sum(times) / len(times)))
+        if self.state_cache is not None:
+            rows.append('  state cache: {hits} hits, {misses} misses ({hit rate:.1%}), {size}/{maxsize} entries'.format(
+                **self.state_cache.stats()))
+        return '\n'.join(rows)
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
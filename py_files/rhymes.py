@@ -0,0 +1,69 @@
+import collections
+
+'''offline perfect rhymes from the cmudict phonemes, in place of the Datamuse rel_rhy queries'''
+'''two words rhyme when a pronunciation of each is the same from its last stressed vowel to the end (the rhyme class), as Datamuse's perfect rhymes are'''
+
+def read_pronunciations(fname):
+    '''cmudict file -> word to its list of phoneme lists, alternative pronunciations (word(1), ...) folded into the word'''
+    pronunciations = collections.defaultdict(list)
+    with open(fname) as f:
+        for line in f:
+            if(";;;" in line):
+                continue
+            line = line.split()
+            if(not line):
+                continue
+            word = line[0].lower()
+            if("(" in word and ")" in word):
+                word = word[:-3]
+            pronunciations[word].append(line[1:])
+    return pronunciations
+
+def rhyme_class(phones):
+    '''the phonemes from the last stressed vowel on, stress marks dropped; the last vowel for a word with no stressed one'''
+    vowels = [i for i, phone in enumerate(phones) if phone[-1] in "012"]
+    if(not vowels):
+        return None
+    stressed = [i for i in vowels if phones[i][-1] in "12"]
+    start = stressed[-1] if stressed else vowels[-1]
+    return tuple(phone.rstrip("012") for phone in phones[start:])
+
+class RhymeIndex():
+    def __init__(self, fname, pos_to_words=None):
+        '''fname is cmudict-0.7b.txt; pos_to_words is postag_dict_all.p[1], needed only to filter by pos'''
+        self.classes = collections.defaultdict(set)
+        self.word_classes = {}
+        for word, pronunciations in read_pronunciations(fname).items():
+            classes = set(rhyme_class(phones) for phones in pronunciations) - set([None])
+            self.word_classes[word] = classes
+            for c in classes:
+                self.classes[c].add(word)
+        self.pos_to_words = {pos: set(words) for pos, words in pos_to_words.items()} if pos_to_words is not None else None
+        self.cache = {}
+
+    def __contains__(self, word):
+        return word.lower() in self.word_classes
+
+    def rhymes_with(self, word, pos=None):
+        '''the words that rhyme with word, word itself left out, as a frozenset; empty for a word cmudict does not have (or a word that is not a str)'''
+        '''pos (a tag or a list of tags) keeps only the words postag_dict_all lists under one of them'''
+        if(not isinstance(word, str)):
+            return frozenset()
+        word = word.lower()
+        if(word not in self.cache):
+            rhymes = set()
+            for c in self.word_classes.get(word, ()):
+                rhymes |= self.classes[c]
+            rhymes.discard(word)
+            self.cache[word] = frozenset(rhymes)
+        rhymes = self.cache[word]
+        if(pos is None):
+            return rhymes
+        if(self.pos_to_words is None):
+            raise ValueError('RhymeIndex was built without pos_to_words')
+        tags = [pos] if isinstance(pos, str) else pos
+        return rhymes & set().union(*[self.pos_to_words.get(tag, ()) for tag in tags])
+
+    def rhyme(self, w1, w2):
+        '''True when w1 and w2 share a rhyme class'''
+        return bool(self.word_classes.get(w1.lower(), set()) & self.word_classes.get(w2.lower(), set()))
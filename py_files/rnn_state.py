@@ -0,0 +1,46 @@
+import collections
+import numpy as np
+
+'''helpers for moving RNN states between the batch-1 form compute_fx uses and the row-stacked form of a whole beam'''
+'''and for padding a batch of word sequences into the step inputs of a batched scorer'''
+'''a state is whatever sess.run returns for the MultiRNNCell state: a tuple with one entry per layer, each an array or an LSTMStateTuple of arrays'''
+
+LSTMStateTuple = collections.namedtuple('LSTMStateTuple', ('c', 'h'))
+
+def map_state(fn, *states):
+    '''applies fn leaf by leaf to one or more states that share the same nesting'''
+    first = states[0]
+    if isinstance(first, tuple):
+        children = [map_state(fn, *parts) for parts in zip(*states)]
+        if hasattr(first, '_fields'):
+            return type(first)(*children)
+        return tuple(children)
+    return fn(*states)
+
+def stack_states(states):
+    '''row-stacks a list of states (batch 1 or more each) into one batched state'''
+    return map_state(lambda *rows: np.concatenate(rows, axis=0), *states)
+
+def take_rows(state, rows):
+    '''gathers the given rows (an index array or a slice) of a batched state'''
+    return map_state(lambda a: a[rows], state)
+
+def state_output(state):
+    '''the top layer output a state ended on: h of the last layer (LSTM), the last layer's state itself otherwise'''
+    top = state[-1]
+    return top.h if hasattr(top, 'h') else top
+
+def split_states(state, n):
+    '''inverse of stack_states: n batch-1 states, one per row'''
+    return [take_rows(state, slice(i, i + 1)) for i in range(n)]
+
+def pad_sequences(vocab, seqs):
+    '''(inputs, targets, lengths) for scoring seqs in one batch: row i feeds seqs[i][:-1] and predicts seqs[i][1:], zero-padded to the longest row'''
+    lengths = np.array([max(len(seq) - 1, 0) for seq in seqs], dtype=np.int32)
+    inputs = np.zeros((len(seqs), max(lengths.max(initial=0), 1)), dtype=np.int32)
+    targets = np.zeros_like(inputs)
+    for row, seq in enumerate(seqs):
+        ids = [vocab[word] for word in seq]
+        inputs[row, :lengths[row]] = ids[:-1]
+        targets[row, :lengths[row]] = ids[1:]
+    return inputs, targets, lengths
@@ -0,0 +1,151 @@
+import time
+import queue
+import asyncio
+import collections
+import threading
+import concurrent.futures
+import numpy as np
+
+from .rnn_state import stack_states, take_rows
+
+'''micro-batching in front of one restored model: single steps submitted by concurrent generations (threads or asyncio tasks) are run together'''
+'''one dispatcher thread waits for the first pending step, collects more until max_batch_size rows or max_wait seconds, then makes one model call and hands each caller back its rows'''
+'''MicroBatcher has the step methods of the models (compute_fx, compute_fx_batch, compute_fx_candidates), so it is passed to the searches in place of the model'''
+
+Request = collections.namedtuple('Request', ('temp', 'p', 'ids', 'state', 'cand_ids', 'future'))
+
+class MicroBatcher():
+    def __init__(self, session, max_batch_size=256, max_wait=0.002):
+        '''session is a model_session.ModelSession; max_batch_size counts beam rows, max_wait is how long the first step of a batch waits for company'''
+        self.model = session.model
+        self.sess = session.sess
+        self.zero_state = session.zero_state
+        '''the backward models are fed the first word of the sequence, the forward ones the last'''
+        self.word_index = 0 if getattr(session.saved_args, 'reverse', 0) else -1
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        '''set by close(); the lock keeps every accepted step ahead of the stop marker in the queue'''
+        self.closed = False
+        self.submit_lock = threading.Lock()
+        self.batches = 0
+        self.steps = 0
+        self.rows = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        '''everything that is not a single step (score_a_list, score_batch, state_cache, ...) is the model's own'''
+        return getattr(self.model, name)
+
+    def submit(self, p, ids, state, cand_ids=None, temp=1):
+        '''queues one step of a beam level; the future resolves to what compute_fx_candidates (or compute_fx_batch for cand_ids None) returns for these rows'''
+        future = concurrent.futures.Future()
+        ids = np.atleast_1d(np.asarray(ids))
+        p = np.broadcast_to(np.reshape(p, (-1,)), ids.shape)
+        with self.submit_lock:
+            if(self.closed):
+                raise RuntimeError('MicroBatcher is closed')
+            self.requests.put(Request(temp, p, ids, state, cand_ids, future))
+        return future
+
+    def run(self):
+        while(True):
+            first = self.requests.get()
+            if(first is None):
+                return
+            pending = [first]
+            rows = len(first.ids)
+            deadline = time.monotonic() + self.max_wait
+            closing = False
+            while(rows < self.max_batch_size):
+                timeout = deadline - time.monotonic()
+                if(timeout <= 0):
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if(request is None):
+                    closing = True
+                    break
+                pending.append(request)
+                rows += len(request.ids)
+            self.flush(pending)
+            if(closing):
+                return
+
+    def flush(self, pending):
+        '''one model call per temperature and kind of step (full distribution or candidates) among the pending steps'''
+        groups = collections.defaultdict(list)
+        for request in pending:
+            groups[(request.temp, request.cand_ids is None)].append(request)
+        for (temp, full), requests in groups.items():
+            try:
+                self.run_group(requests, temp, full)
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+
+    def run_group(self, requests, temp, full):
+        p = np.concatenate([request.p for request in requests])
+        ids = np.concatenate([request.ids for request in requests])
+        state = stack_states([request.state for request in requests])
+        if(full):
+            dist, state = self.model.compute_fx_batch(self.sess, p, ids, state, temp)
+        else:
+            '''scored on the union of the candidates, each step gets back its own columns'''
+            union = np.unique(np.concatenate([request.cand_ids for request in requests]))
+            dist, state = self.model.compute_fx_candidates(self.sess, p, ids, state, union, temp)
+        self.batches += 1
+        self.steps += len(requests)
+        self.rows += len(ids)
+        start = 0
+        for request in requests:
+            rows = slice(start, start + len(request.ids))
+            rows_dist = dist[rows] if full else dist[rows][:, np.searchsorted(union, request.cand_ids)]
+            request.future.set_result((rows_dist, take_rows(state, rows)))
+            start += len(request.ids)
+
+    def compute_fx_candidates(self, sess, p, ids, state, cand_ids, temp=1):
+        return self.submit(p, ids, state, cand_ids, temp).result()
+
+    def compute_fx_batch(self, sess, p, ids, state, temp=1):
+        return self.submit(p, ids, state, None, temp).result()
+
+    def compute_fx(self, sess, vocab, p, x, state, temp):
+        '''same result as the model's compute_fx, run as a one-row compute_fx_batch'''
+        if state is None:
+            state = self.zero_state
+        log_probs, state = self.compute_fx_batch(sess, 0., [vocab[x[self.word_index]]], state, temp)
+        return (np.asarray(p).squeeze() + log_probs[0]).squeeze(), state
+
+    async def compute_fx_candidates_async(self, p, ids, state, cand_ids, temp=1):
+        '''for asyncio callers: waits for the batch without blocking the event loop'''
+        return await asyncio.wrap_future(self.submit(p, ids, state, cand_ids, temp))
+
+    async def compute_fx_batch_async(self, p, ids, state, temp=1):
+        return await asyncio.wrap_future(self.submit(p, ids, state, None, temp))
+
+    def stats(self):
+        '''model calls made, steps and rows they served, to see how much the batching shares'''
+        return collections.OrderedDict([('batches', self.batches), ('steps', self.steps), ('rows', self.rows),
+            ('steps per batch', self.steps / self.batches if self.batches else 0.),
+            ('rows per batch', self.rows / self.batches if self.batches else 0.)])
+
+    def close(self):
+        '''runs the steps submitted before it, then stops the dispatcher thread; later submits raise RuntimeError'''
+        with self.submit_lock:
+            if(self.closed):
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.thread.join()
+        '''anything the dispatcher did not get to is failed rather than left waiting forever'''
+        while(True):
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if(request is not None and not request.future.done()):
+                request.future.set_exception(RuntimeError('MicroBatcher closed before this step ran'))
@@ -0,0 +1,288 @@
+import numpy as np
+
+from .rnn_state import take_rows, split_states, stack_states
+from .beam import Beam, BeamHistory
+
+'''the constrained beam search every search in functions.py runs on: one engine, parameterised by direction, Constraints and scorer'''
+'''batched expansion, candidate lookup and the array-backed beam live here once, so every caller gets them'''
+
+def level_candidates(vocab, PartOfSpeachSet, pos, dictSyllables=None, sylls=None, candidates=None):
+    '''the words any hypothesis of a beam level may take at template slot pos, their vocab ids and their lengths'''
+    '''every hypothesis of a level fills the same slot, so this is worked out once per level'''
+    '''given a candidates.CandidateIndex built at load time it is a dict lookup instead'''
+    if(candidates is not None):
+        return candidates.get(pos, sylls, meter=dictSyllables is not None)
+    words = []
+    for word in list(set(PartOfSpeachSet[pos])):
+        if(word not in vocab):
+            continue
+        if(dictSyllables is not None):
+            if (word not in dictSyllables):
+                continue
+            if word not in ('.', ',') and len(dictSyllables[word][0]) != sylls:
+                continue
+        words+=[word]
+    return words, np.array([vocab[word] for word in words], dtype=np.int32), np.array([len(word) for word in words])
+
+def repeat_weights(n, scale):
+    '''what decayRepeat adds for a repeat of the word at each of n sequence positions: -scale at the first, scale/10 less at each one after'''
+    weights = np.empty(n)
+    decr = -scale
+    for w in range(n):
+        weights[w] = decr
+        decr += scale/10
+    return weights
+
+def word_pool_mask(vocab, wordPool, cand_ids):
+    '''True for the candidates that are in wordPool'''
+    return np.isin(cand_ids, [vocab[word] for word in wordPool if word in vocab])
+
+def score_branches(scores, cand_ids, lengths, in_pool, seq_ids, adjacent_id, scale, breadth, keep=None):
+    '''the beamSearchOneLevel score adjustments for every candidate of one hypothesis at once; seq_ids are the vocab ids of its words (-1 if not in vocab)'''
+    '''repeats are penalised through a (sequence position x candidate) mask weighted by repeat_weights, so the sums come out as decayRepeat's'''
+    '''drops the adjacent repeat, -inf scores and candidates keep rules out, then returns the indices of the (at most breadth) best children, in candidate order, and their scores'''
+    repeats = seq_ids[:, None] == cand_ids[None, :]
+    score_adjust = (repeat_weights(len(seq_ids), 100*scale)[:, None] * repeats).sum(axis=0) #repeats
+    score_adjust += scale*lengths/50 #length word
+    score_adjust[in_pool] += scale
+    new_probs = scores + score_adjust.astype(scores.dtype)
+    ok = (cand_ids != adjacent_id) & ~np.isneginf(new_probs)
+    if(keep is not None):
+        ok &= keep
+    branches = np.flatnonzero(ok)
+    #ONLY THE BREADTH BEST CHILDREN OF A HYPOTHESIS CAN SURVIVE THE LEVEL
+    if(len(branches) > breadth):
+        branches = np.sort(branches[np.argpartition(-new_probs[branches], breadth - 1)[:breadth]])
+    return branches, new_probs[branches]
+
+class Constraints():
+    def __init__(self, TemplatePOS, PartOfSpeachSet, TemplateSyllables=None, dictSyllables=None, stress=None, rhymes=None, \
+                dictPartSpeechTags=None, dictPossiblePartsSpeech=None, candidates=None):
+        '''what a line found by beam_search may contain; everything after PartOfSpeachSet is optional'''
+        '''TemplatePOS: one pos tag per word of the line, each word drawn from PartOfSpeachSet[tag]'''
+        '''TemplateSyllables, dictSyllables: syllables per word and the cmudict meters, as the *_meter searches take them'''
+        '''stress: '0'/'1' string over the whole line; each word needs a pronunciation matching its share of it (needs the syllable template)'''
+        '''rhymes: set of words the last word of the line must come from'''
+        '''dictPartSpeechTags, dictPossiblePartsSpeech: word -> tag and tag -> tags allowed just before it, to filter pos transitions'''
+        '''candidates: a candidates.CandidateIndex, so the pos/syllable lookup is precomputed'''
+        if(stress is not None and TemplateSyllables is None):
+            raise ValueError('A stress pattern needs a syllable template')
+        self.TemplatePOS = TemplatePOS
+        self.PartOfSpeachSet = PartOfSpeachSet
+        self.TemplateSyllables = TemplateSyllables
+        self.dictSyllables = dictSyllables
+        self.stress = stress
+        self.rhymes = rhymes
+        self.dictPartSpeechTags = dictPartSpeechTags
+        self.dictPossiblePartsSpeech = dictPossiblePartsSpeech
+        self.candidates = candidates
+        if(stress is not None):
+            self.stress_offsets = np.cumsum([0]+list(TemplateSyllables))
+        self.slot_cache = {}
+        self.allowed_tags = {}
+
+    def __len__(self):
+        return len(self.TemplatePOS)
+
+    def slot_candidates(self, vocab, slot):
+        '''(words, ids, lengths) the template lets slot take, worked out once per slot'''
+        slot = slot % len(self.TemplatePOS)
+        if(slot not in self.slot_cache):
+            if(self.TemplateSyllables is not None):
+                words, ids, lengths = level_candidates(vocab, self.PartOfSpeachSet, self.TemplatePOS[slot], self.dictSyllables, self.TemplateSyllables[slot], self.candidates)
+            else:
+                words, ids, lengths = level_candidates(vocab, self.PartOfSpeachSet, self.TemplatePOS[slot], candidates=self.candidates)
+            mask = np.ones(len(words), dtype=bool)
+            if(self.stress is not None):
+                pattern = self.stress[self.stress_offsets[slot]:self.stress_offsets[slot + 1]]
+                mask &= np.array([pattern in self.dictSyllables.get(word, []) for word in words], dtype=bool)
+            if(self.rhymes is not None and slot == len(self.TemplatePOS) - 1):
+                mask &= np.array([word in self.rhymes for word in words], dtype=bool)
+            if(not mask.all()):
+                words = [word for word, ok in zip(words, mask) if ok]
+                ids, lengths = ids[mask], lengths[mask]
+            tags = None
+            if(self.dictPartSpeechTags is not None):
+                tags = np.array([self.dictPartSpeechTags.get(word, '') for word in words])
+            self.slot_cache[slot] = (words, ids, lengths, tags)
+        return self.slot_cache[slot][:3]
+
+    def transition_mask(self, slot, adjacent, backward):
+        '''which candidates of slot may sit next to adjacent, the word already on the side the line grows from; None when pos transitions are not filtered'''
+        '''a word without a tag never passes, matching partsOfSpeechFilter'''
+        if(self.dictPartSpeechTags is None):
+            return None
+        tags = self.slot_cache[slot % len(self.TemplatePOS)][3]
+        key = (self.dictPartSpeechTags.get(adjacent), backward)
+        if(key not in self.allowed_tags):
+            tag, possible = key[0], self.dictPossiblePartsSpeech
+            if(tag is None):
+                allowed = []
+            elif(backward):
+                #THE NEW WORD COMES BEFORE ADJACENT
+                allowed = list(possible.get(tag, ()))
+            else:
+                #THE NEW WORD COMES AFTER ADJACENT
+                allowed = [after for after, before in possible.items() if tag in before]
+            self.allowed_tags[key] = allowed
+        return np.isin(tags, self.allowed_tags[key])
+
+class SearchCancelled(Exception):
+    pass
+
+class CancellableModel():
+    '''the step methods of model, checking cancelled() before each one: every beam level is one step, so a search nobody waits for any more stops at its next level'''
+    def __init__(self, model, cancelled):
+        self.model = model
+        self.cancelled = cancelled
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def compute_fx_candidates(self, *args, **kwargs):
+        if(self.cancelled()):
+            raise SearchCancelled()
+        return self.model.compute_fx_candidates(*args, **kwargs)
+
+    def compute_fx_batch(self, *args, **kwargs):
+        if(self.cancelled()):
+            raise SearchCancelled()
+        return self.model.compute_fx_batch(*args, **kwargs)
+
+class BeamSearch():
+    '''one beam_search in progress, advanced a level at a time so several searches can share each model call (see beam_search_many)'''
+    '''level() says what the current level feeds the model, advance() takes the scores and state the model returned for it'''
+    def __init__(self, vocab, prob_sequence, sequence, state, breadth, wordPool, constraints, \
+                backward=True, scorer=score_branches, scale=.02, report_dead_ends=False):
+        self.vocab = vocab
+        self.sequence = sequence
+        self.state = state
+        self.breadth = breadth
+        self.wordPool = wordPool
+        self.constraints = constraints
+        self.backward = backward
+        self.scorer = scorer
+        self.scale = scale
+        self.report_dead_ends = report_dead_ends
+        self.prob_sequence = prob_sequence
+        self.word_index = 0 if backward else -1
+        self.beam = Beam(breadth)
+        self.history = BeamHistory()
+        self.root_ids = np.array([vocab.get(word, -1) for word in sequence])
+        self.id_to_word = {}
+        self.nodes = np.zeros(1, dtype=np.int64)
+        self.p = np.array([np.asarray(prob_sequence).item()]) if len(sequence) < len(constraints) else None
+        self.ids = np.array([vocab[sequence[self.word_index]]])
+        self.set_explored = set([])
+        self.depth = 0
+        self.dead = False
+
+    @property
+    def done(self):
+        return self.dead or len(self.sequence) + self.depth >= len(self.constraints)
+
+    def level(self):
+        '''(p, ids, state, cand_ids) of the current level: the rows to feed the model and the ids its slot allows'''
+        self.slot = -(len(self.sequence) + self.depth)-1 if self.backward else len(self.sequence) + self.depth
+        self.cand_words, self.cand_ids, self.lengths = self.constraints.slot_candidates(self.vocab, self.slot)
+        if(len(self.cand_ids)==0):
+            self.dead = True
+        return self.p, self.ids, self.state, self.cand_ids
+
+    def advance(self, scores, next_state):
+        '''scores the children of every hypothesis and keeps the breadth best; scores are (rows, len(cand_ids)) as compute_fx_candidates returns them'''
+        vocab, sequence, backward, depth, word_index = self.vocab, self.sequence, self.backward, self.depth, self.word_index
+        cand_words, cand_ids, lengths = self.cand_words, self.cand_ids, self.lengths
+        history, nodes = self.history, self.nodes
+        in_pool = word_pool_mask(vocab, self.wordPool, cand_ids)
+        #WORD IDS OF EVERY HYPOTHESIS, IN LINE ORDER, GATHERED FROM THE BACKPOINTERS
+        path = history.paths(nodes, depth)
+        roots = np.tile(self.root_ids, (len(nodes), 1))
+        seq_ids = np.hstack([path[:, ::-1], roots] if backward else [roots, path])
+        child_scores, child_parents, child_cands = [], [], []
+        for row, node in enumerate(nodes):
+            adjacent = self.id_to_word[seq_ids[row, word_index]] if depth else sequence[word_index]
+            keep = self.constraints.transition_mask(self.slot, adjacent, backward)
+            branches, new_probs = self.scorer(scores[row], cand_ids, lengths, in_pool, seq_ids[row], seq_ids[row, word_index], self.scale, self.breadth, keep)
+            if(self.report_dead_ends and len(branches) < 1):
+                print(rebuild_line(history, self.id_to_word, sequence, node, depth, backward))
+                print(self.constraints.TemplatePOS)
+            #need to make sure each phrase is being checked uniquely
+            for k, new_prob, h in zip(branches, new_probs, history.child_hashes(node, cand_ids[branches])):
+                if(h in self.set_explored):
+                    continue
+                self.set_explored.add(h)
+                child_scores.append(new_prob)
+                child_parents.append(row)
+                child_cands.append(k)
+        if(len(child_scores)==0):
+            self.dead = True
+            return
+        #KEEP THE BREADTH BEST CHILDREN OF THE LEVEL; EACH TAKES ITS PARENT'S ROW OF THE NEW STATE
+        beam = self.beam
+        keep = beam.select(np.array(child_scores), child_parents, cand_ids[child_cands])
+        for c in keep:
+            self.id_to_word[cand_ids[child_cands[c]]] = cand_words[child_cands[c]]
+        self.nodes = history.add(nodes[beam.parents], beam.tokens)
+        self.p = beam.scores
+        self.ids = beam.tokens
+        self.state = take_rows(next_state, beam.parents)
+        self.depth += 1
+
+    def results(self):
+        '''the finished lines as (score, ((score, state), sequence)) items, worst first; [] for a search that died'''
+        if(self.dead):
+            return []
+        if(self.depth == 0):
+            return [(self.prob_sequence,((self.prob_sequence, self.state), self.sequence))]
+        checkList = []
+        for score, row_state, node in zip(self.beam.scores, split_states(self.state, len(self.beam)), self.nodes):
+            score = np.reshape(score, (1, 1))
+            checkList+=[(score,((score, row_state), rebuild_line(self.history, self.id_to_word, self.sequence, node, self.depth, self.backward)))]
+        return checkList
+
+def beam_search(model, vocab, prob_sequence, sequence, state, session, temp, breadth, wordPool, constraints, \
+                backward=True, scorer=score_branches, scale=.02, report_dead_ends=False):
+    '''grows sequence word by word until it fills constraints.TemplatePOS, keeping the breadth best hypotheses at each level'''
+    '''every hypothesis of a level is run through the model in one batched call and scored only on the candidates its slot allows'''
+    '''backward searches grow the line to the left and feed the model its first word, forward ones grow it to the right'''
+    '''scorer has score_branches' signature and picks each hypothesis' children; scale is what its adjustments are sized by'''
+    '''hypotheses are beam.BeamHistory nodes; their words are rebuilt from the backpointers only once the lines are finished'''
+    '''returns the finished lines as (score, ((score, state), sequence)) items, worst first'''
+    search = BeamSearch(vocab, prob_sequence, sequence, state, breadth, wordPool, constraints, backward, scorer, scale, report_dead_ends)
+    while(not search.done):
+        #ONE BATCHED MODEL CALL FOR THE WHOLE LEVEL, SCORED ONLY ON THE WORDS THE SLOT ALLOWS
+        p, ids, state, cand_ids = search.level()
+        if(search.done):
+            break
+        search.advance(*model.compute_fx_candidates(session, p, ids, state, cand_ids, temp))
+    return search.results()
+
+def beam_search_many(model, searches, session, temp):
+    '''runs several BeamSearch at once: each level, the rows of every unfinished search go through the model in one call'''
+    '''the call is scored on the union of the searches' candidates and each search gets back its own rows and columns'''
+    '''returns the results() of each search, in order'''
+    while(True):
+        levels = []
+        for search in searches:
+            if(not search.done):
+                level = search.level()
+                if(not search.done):
+                    levels.append((search, level))
+        if(len(levels)==0):
+            break
+        union = np.unique(np.concatenate([level[3] for _, level in levels]))
+        p = np.concatenate([level[0] for _, level in levels])
+        ids = np.concatenate([level[1] for _, level in levels])
+        scores, next_state = model.compute_fx_candidates(session, p, ids, stack_states([level[2] for _, level in levels]), union, temp)
+        start = 0
+        for search, (p, _, _, cand_ids) in levels:
+            rows = slice(start, start + len(p))
+            search.advance(scores[rows][:, np.searchsorted(union, cand_ids)], take_rows(next_state, rows))
+            start += len(p)
+    return [search.results() for search in searches]
+
+def rebuild_line(history, id_to_word, sequence, node, depth, backward):
+    '''the words of a beam_search hypothesis: the starting sequence plus the tokens on the path to node'''
+    words = [id_to_word[token] for token in history.paths([node], depth)[0]]
+    return words[::-1]+sequence if backward else sequence+words
@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import collections
+import numpy as np
+
+from .rnn_state import map_state, take_rows, stack_states
+
+'''bounded LRU memo of RNN steps, so a suffix the searches already encoded (the same last word under another template, the same fourth line under another fifth) is not run through the model again'''
+'''a beam step is memoised per row on (temp, state digest, token) -> (next state row, normaliser): num_layers x 2 x rnn_size floats per entry (24 KB for the 3 x 1000 LSTMs), the scores are recomputed from the next state's top layer output'''
+'''each model keeps its own cache (see ModelSession), so the model is implicit in the keys; the lines generated on threads at once share it under a lock'''
+
+def state_key(state):
+    '''digest of the contents of a state, so a step is found again whichever object holds the state'''
+    digest = hashlib.blake2b(digest_size=16)
+    map_state(lambda leaf: digest.update(np.ascontiguousarray(leaf).tobytes()), state)
+    return digest.digest()
+
+def lookup_rows(cache, temp, ids, state):
+    '''splits the rows of a beam step into those the cache lacks and those it holds'''
+    '''returns (keys, missing, hit, hit_state, hit_norms): row indices of each kind, and the cached next states and (rows, 1) normalisers of the hit rows'''
+    keys = [('step', temp, state_key(take_rows(state, slice(r, r + 1))), int(token)) for r, token in enumerate(np.asarray(ids))]
+    steps = [cache.get(key) for key in keys]
+    missing = np.array([r for r, step in enumerate(steps) if step is None], dtype=np.int64)
+    hit = np.array([r for r, step in enumerate(steps) if step is not None], dtype=np.int64)
+    hit_state = stack_states([steps[r][0] for r in hit]) if len(hit) else take_rows(state, hit)
+    hit_norms = np.array([steps[r][1] for r in hit], dtype=np.float32).reshape(-1, 1)
+    return keys, missing, hit, hit_state, hit_norms
+
+def store_rows(cache, keys, missing, miss_state, miss_norms):
+    '''caches the next state and normaliser of each row that was run; the row is copied out (a list index, not a slice) so the entry does not keep the whole batch alive'''
+    for n, r in enumerate(missing):
+        cache.put(keys[r], (take_rows(miss_state, [n]), float(np.ravel(miss_norms)[n])))
+
+def merge_rows(missing, hit, miss_part, hit_part):
+    '''puts per-row results computed as the missing rows then the hit rows back in the beam's order (states or arrays)'''
+    order = np.argsort(np.concatenate([missing, hit]), kind='stable')
+    return take_rows(stack_states([miss_part, hit_part]), order)
+
+class StateCache():
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        '''the cached value for key, counted as a hit or a miss'''
+        with self.lock:
+            if(key in self.entries):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while(len(self.entries) > self.maxsize):
+                self.entries.popitem(last=False)
+
+    def longest_prefix(self, temp, ids):
+        '''for score_a_list: the most steps of ids already run from the initial state, and the (cumulative score, state) they ended on'''
+        '''score_a_list stores ('score_a_list', temp, ids[:i+2]) after feeding ids[i], its score then covering ids[1:i+2]'''
+        with self.lock:
+            for k in range(len(ids), 1, -1):
+                key = ('score_a_list', temp, tuple(ids[:k]))
+                if(key in self.entries):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return k - 1, self.entries[key]
+            self.misses += 1
+            return 0, None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''hits, misses and size, to measure what the cache saves'''
+        calls = self.hits + self.misses
+        return collections.OrderedDict([('hits', self.hits), ('misses', self.misses),
+            ('hit rate', self.hits / calls if calls else 0.), ('size', len(self.entries)), ('maxsize', self.maxsize)])